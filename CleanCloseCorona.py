@@ -1,23 +1,24 @@
+import pickle
+import random
 import time
+import zlib
 from enum import IntEnum
 from typing import Any
 from mesa import Model, Agent
 import numpy as np
-from mesa.datacollection import DataCollector
 from mesa.space import MultiGrid
 from mesa.time import RandomActivation
 
-from itertools import combinations
-
-from utils_for_clean_close_model import throw_coin, DecisionNode, HealthStatus, Action, logistic_prob, CountryStatus, \
-    AirStatus, build_moving_decision_tree, dist, rect_area, lower_first, Queue
+from utils_for_clean_close_model import throw_coin, DecisionNode, HealthStatus, Action, CountryStatus, \
+    AirStatus, build_moving_decision_tree, dist, rect_area, lower_first, normalize_factors, \
+    logistic_prob_normalized, logistic_prob_batch, RandomStream, LazyThresholds
 from utils_for_corona_model import generate_age
-
-
-class DrawingOnGridAgent(Agent):
-    def __init__(self, unique_id: int, model: Model):
-        super().__init__(unique_id, model)
-        self.health = HealthStatus.HEALTHY
+from agent_state import AgentStateStore, state_field, state_pos_field
+from grid_fields import CellIndex, CrowdField, VenueLayout, neighborhood_table
+from data_collection import SeriesCollector
+from infection_log import InfectionLog
+from relationships import RelationshipStore, partner_rank, batch_partners
+from tracing import DECISION, ACTION, INFECTION
 
 
 def choose_seat_around_table(pos: (int, int), x: int):
@@ -80,6 +81,15 @@ def contagious_action(action):
     return 0
 
 
+# contagious_action and mask_protection as lookup tables for the vectorized contagion
+CONTAGIOUS_ACTION = np.array([contagious_action(a) for a in Action])
+# Index into infRate by the number of masks in the couple (none, one, both)
+MASK_PROTECTION_INDEX = np.array([3, 1, 0])
+
+# Equal weights of the variables of the action threshold
+ACTION_WEIGHTS = normalize_factors([1, 1, 1, 1, 1])
+
+
 def influence_action_on_wearing_mask(action, conference):
     if action == Action.EATING:
         return 0.1
@@ -94,14 +104,52 @@ def influence_action_on_wearing_mask(action, conference):
     return 1
 
 
+# The method of PopAgent for every action of the moving decision tree
+MOVE_ACTIONS = {'random_move': 'random_move', 'move_away': 'move_away', 'conference_move': 'conference_move',
+                'out_move': 'out_move', 'friends_move': 'move_friends', 'back_seat_move': 'back_seat_move'}
+
+# Number of seats around a table
+TABLE_SEATS = 10
+
+# Constructor arguments that shape the agents, the grid or the venue of a snapshot: a fork can not replace them
+FORK_FIXED_PARAMS = ('N', 'height', 'width', 'relationship', 'tables', 'waiters')
+
+# The PopAgent methods that give the thresholds of the moving decision tree nodes (called with possible_steps)
+MOVE_THRESHOLDS = {'there_is_conference': 'there_is_conference_threshold',
+                   'go_to_conference': 'go_to_conference_threshold',
+                   'move_away_from_crowd': 'move_away_from_crowd_threshold',
+                   'is_in_conference_1': 'in_conference_threshold',
+                   'is_in_conference_2': 'in_conference_threshold',
+                   'random_or_friends': 'friends_threshold',
+                   'back_seat_or_move_away': 'back_seat_threshold',
+                   'back_seat_or_move_out': 'back_seat_threshold',
+                   'back_seat_or_friends': 'back_seat_threshold'}
+
+
 class PopAgent(Agent):
+    # The agent state lives in the model's AgentStateStore, the agent is a view on row self.idx
+    age = state_field('age', float)
+    infects_others_level = state_field('infects_others_level', float)
+    infects_by_others_level = state_field('infects_by_others_level', float)
+    social_influence = state_field('social_influence', float)
+    infection_generation = state_field('infection_generation', int)
+    infection_tick = state_field('infection_tick', int)
+    active = state_field('active', bool)
+    base_pos = state_pos_field('base_pos')
+    last_time_in_seat = state_field('last_time_in_seat', int)
+    current_action = state_field('current_action', int)
+    continue_action = state_field('continue_action', float)
+    action_done = state_field('action_done', bool)
+
     def __init__(self, unique_id: int, model: Model, health=HealthStatus.HEALTHY):
+        self.idx = model.agent_state.allocate(self)
         super().__init__(unique_id, model)
+        model.agent_state.unique_id[self.idx] = unique_id
 
         # Fixed fields
         self.age = generate_age()
-        self.infects_others_level = np.random.normal(0.5, 0.25)
-        self.infects_by_others_level = np.random.normal(0.5, 0.25)
+        self.infects_others_level = model.rng.normal(0.5, 0.25)
+        self.infects_by_others_level = model.rng.normal(0.5, 0.25)
 
         # Changeable fields
         self.health = health
@@ -109,8 +157,10 @@ class PopAgent(Agent):
         self.social_influence = 0
         if self.health == HealthStatus.CARRIED:
             self.infection_generation = 1
+            self.infection_tick = 0
         else:
             self.infection_generation = 0
+            self.infection_tick = -1
         self.active = False
 
         # Table fields
@@ -123,6 +173,59 @@ class PopAgent(Agent):
         self.partner = self
         self.action_done = False
 
+        # Friends levels of the possible steps, computed at most once per tick (see friends_levels)
+        self._friends_levels = None
+        self._friends_levels_time = -1
+
+    @property
+    def partner(self):
+        store = self.model.agent_state
+        return store.agents[store.partner[self.idx]]
+
+    @partner.setter
+    def partner(self, agent):
+        self.model.agent_state.partner[self.idx] = agent.idx
+
+    @property
+    def health(self):
+        return int(self.model.agent_state.health[self.idx])
+
+    @health.setter
+    def health(self, new_health):
+        carried_before = int(self.model.agent_state.health[self.idx] == HealthStatus.CARRIED)
+        self.model.agent_state.health[self.idx] = new_health
+        self.model.carried_count += int(new_health == HealthStatus.CARRIED) - carried_before
+
+    @property
+    def mask(self):
+        return bool(self.model.agent_state.mask[self.idx])
+
+    @mask.setter
+    def mask(self, new_mask):
+        self.model.mask_count += int(bool(new_mask)) - int(self.model.agent_state.mask[self.idx])
+        self.model.agent_state.mask[self.idx] = new_mask
+
+    @property
+    def pos(self):
+        x, y = self.model.agent_state.pos[self.idx]
+        if x < 0:
+            return None
+        return int(x), int(y)
+
+    @pos.setter
+    def pos(self, new_pos):
+        # Called by the grid on every place/move, keeps the crowd field and the crowd counter up to date
+        old_pos = self.model.agent_state.pos[self.idx]
+        if old_pos[0] >= 0:
+            self.model.crowd.remove(old_pos)
+            self.model.crowd_count -= int(self.model.gathering_layer[old_pos[0], old_pos[1]])
+        if new_pos is None:
+            self.model.agent_state.pos[self.idx] = (-1, -1)
+        else:
+            self.model.agent_state.pos[self.idx] = new_pos
+            self.model.crowd.add(new_pos)
+            self.model.crowd_count += int(self.model.gathering_layer[new_pos[0], new_pos[1]])
+
     # Different moving
     def random_move(self, possible_steps):
         new_position = self.random.choice([pos for pos in possible_steps])
@@ -143,11 +246,10 @@ class PopAgent(Agent):
         self.model.grid.move_agent(self, new_position)
 
     def out_move(self, possible_steps):
+        # Toward a random cell out of the gathering area, drawn directly from the venue layout
         chosen_destination = self.pos
-        # The probability complexity of this loop is area/(gathering area) ~O(1) for relevant cases
-        while self.model.pos_in_gathering_area(chosen_destination):
-            chosen_destination = (self.random.randrange(0, self.model.grid.height),
-                                  self.random.randrange(0, self.model.grid.width))
+        if self.model.pos_in_gathering_area(chosen_destination) and len(self.model.venue.outside) > 0:
+            chosen_destination = self.random.choice(self.model.venue.outside)
 
         new_position = move_forward(possible_steps, chosen_destination)
         self.model.grid.move_agent(self, new_position)
@@ -156,93 +258,81 @@ class PopAgent(Agent):
         want_stay_at_gathering_area = False
         if self.model.pos_in_gathering_area(self.pos):
             want_stay_at_gathering_area = True
-        index = np.argmin([len(self.model.grid.get_cell_list_contents(
-            self.model.grid.get_neighborhood(pos, moore=True,
-                                             include_center=True,
-                                             radius=1))) for pos in possible_steps
-            if self.model.pos_in_gathering_area(pos) or (not want_stay_at_gathering_area)])
-        new_position = possible_steps[index]
+        candidates = [pos for pos in possible_steps
+                      if self.model.pos_in_gathering_area(pos) or (not want_stay_at_gathering_area)]
+        index = np.argmin([self.model.crowd.count(pos, radius=1) for pos in candidates])
+        new_position = candidates[index]
         self.model.grid.move_agent(self, new_position)
 
+    def friends_levels(self, possible_steps):
+        # Average relationship level with the people around every possible step (0 if there are none),
+        # read from the friend affinity field of this tick. The friends threshold and move_friends share it.
+        if self._friends_levels_time != self.model.time:
+            x, y = self.pos
+            steps = np.array(possible_steps)
+            self._friends_levels = self.model.friend_affinity[self.idx, steps[:, 0] - x + 2, steps[:, 1] - y + 2]
+            self._friends_levels_time = self.model.time
+        return self._friends_levels
+
     def move_friends(self, possible_steps):
-        index = np.argmax([np.average([self.model.relationship_level[
-                                           lower_first(self.unique_id, k.unique_id)]
-                                       for k in self.model.grid.get_cell_list_contents(
-                self.model.grid.get_neighborhood(pos, moore=True,
-                                                 include_center=True,
-                                                 radius=1)) if k != self and
-                                       type(k) == PopAgent]) for pos in possible_steps])
+        index = np.argmax(self.friends_levels(possible_steps))
         new_position = possible_steps[index]
         self.model.grid.move_agent(self, new_position)
 
+    # Thresholds of the moving decision tree nodes (MOVE_THRESHOLDS), computed only on the nodes the walk reaches
+    def there_is_conference_threshold(self, possible_steps):
+        return 1 if self.model.conference else 0
+
+    def go_to_conference_threshold(self, possible_steps):
+        return logistic_prob_normalized(weights=self.model.move_weights,
+                                        variables=[self.age / 100,
+                                                   1 - self.model.conference_crowded / self.model.gathering_area_size])
+
+    def move_away_from_crowd_threshold(self, possible_steps):
+        if not self.model.get_away:
+            return 0
+        return logistic_prob_normalized(weights=self.model.move_weights,
+                                        variables=[self.age / 100,
+                                                   self.model.crowd.count(self.pos, radius=2) / len(possible_steps)])
+
+    def in_conference_threshold(self, possible_steps):
+        return 1 if self.model.pos_in_gathering_area(self.pos) else 0
+
+    def friends_threshold(self, possible_steps):
+        return max(self.friends_levels(possible_steps).tolist())
+
+    def back_seat_threshold(self, possible_steps):
+        return min(float(len(self.model.seating_area)),
+                   (self.model.time - self.last_time_in_seat) / (self.model.time + self.last_time_in_seat))
+
     def move(self, possible_steps, cellmates):
-        # Update tree actions
-        self.model.move_decision_tree.action_dict['random_move'][0] = self.random_move
-        self.model.move_decision_tree.action_dict['move_away'][0] = self.move_away
-        self.model.move_decision_tree.action_dict['conference_move'][0] = self.conference_move
-        self.model.move_decision_tree.action_dict['out_move'][0] = self.out_move
-        self.model.move_decision_tree.action_dict['friends_move'][0] = self.out_move
-        self.model.move_decision_tree.action_dict['back_seat_move'][0] = self.back_seat_move
-
-        # Calculate thresholds
-        threshold_go_conference = logistic_prob(factors=[self.model.mask_coeff[0], self.model.mask_coeff[3]],
-                                                variables=[self.age / 100,
-                                                           1 - self.model.conference_crowded /
-                                                           max(rect_area([k for k in
-                                                                          self.model.gathering_area.values()]), 1)
-                                                           ])
-        threshold_get_away_from_people = logistic_prob(factors=[self.model.mask_coeff[0], self.model.mask_coeff[3]],
-                                                       variables=[self.age / 100,
-                                                                  len(cellmates) / len(possible_steps)
-                                                                  ])
-        threshold_going_to_friends = max([np.average([self.model.relationship_level[
-                                                          (min(self.unique_id, k.unique_id),
-                                                           max(self.unique_id, k.unique_id))]
-                                                      for k in self.model.grid.get_cell_list_contents(
-                self.model.grid.get_neighborhood(pos, moore=True,
-                                                 include_center=True,
-                                                 radius=1)) if k != self and type(k) != DrawingOnGridAgent
-                                                      and type(k) != WaiterAgent])
-                                          for pos in possible_steps])
-
-        # Update thresholds
-        self.model.move_decision_tree.nodes_dict['there_is_conference'].threshold = 1 if self.model.conference else 0
-        self.model.move_decision_tree.nodes_dict['go_to_conference'].threshold = threshold_go_conference
-        self.model.move_decision_tree.nodes_dict['move_away_from_crowd'].threshold = threshold_get_away_from_people \
-            if self.model.get_away else 0
-        self.model.move_decision_tree.nodes_dict['is_in_conference_1'].threshold = \
-            self.model.move_decision_tree.nodes_dict['is_in_conference_2'].threshold = \
-            1 if self.model.pos_in_gathering_area(self.pos) \
-                else 0
-        self.model.move_decision_tree.nodes_dict['random_or_friends'].threshold = threshold_going_to_friends
-        self.model.move_decision_tree.nodes_dict['back_seat_or_move_away'].threshold = \
-            self.model.move_decision_tree.nodes_dict['back_seat_or_move_out'].threshold = \
-            self.model.move_decision_tree.nodes_dict['back_seat_or_friends'].threshold = \
-            min(float(len(self.model.seating_area)),
-                (self.model.time - self.last_time_in_seat) / (self.model.time + self.last_time_in_seat))
+        # The compiled tree is shared and never changed, the thresholds of this agent are evaluated lazily
+        thresholds = LazyThresholds(self.model.move_decision_tree, self.model.move_threshold_providers, self,
+                                    possible_steps)
         path = []
-        chosen_move = self.model.move_decision_tree.calculate_decision(path=path)[0]
+        chosen_move = self.model.move_decision_tree.decide(thresholds, path=path, rng=self.model.rng)
 
-        chosen_move(possible_steps)
+        getattr(self, MOVE_ACTIONS[chosen_move])(possible_steps)
         # Relevant for actions
         return path
 
     def choose_interaction(self, cellmates):
-        # Choose partner to action
-        # sort the neighborhood agents according to relationship with current agent
-        cellmates = [j for i, j in sorted(zip([lower_first(self.unique_id, c.unique_id)
-                                               for c in cellmates], cellmates)) if not j.action_done]
-        if len(cellmates) > 0:
-            index = min(np.random.geometric(0.5), len(cellmates) - 1)
-            self.partner = cellmates[index]
+        # Choose partner to action among the cellmates that are not in another action:
+        # the rank k one by relationship with current agent, k ~ Geometric(0.5) - 1 (the closest is the most likely),
+        # equal levels by agent state store row
+        candidates = [c for c in cellmates if c != self and not c.action_done]
+        if len(candidates) > 0:
+            levels = self.model.relationship_level.lookup(self.unique_id, [c.unique_id for c in candidates])
+            self.partner = candidates[partner_rank(levels, self.model.rng.geometric(0.5) - 1,
+                                                   [c.idx for c in candidates])]
             self.partner.partner = self
         else:
             self.partner = self
 
     # Choose action
     def choose_action(self, move_path, cellmates):
-        if 'back_seat_move' in move_path and self.close_to_seat() and throw_coin(0.5):
-            if throw_coin(0.5):
+        if 'back_seat_move' in move_path and self.close_to_seat() and throw_coin(0.5, self.model.rng):
+            if throw_coin(0.5, self.model.rng):
                 self.current_action = Action.EATING
             else:
                 self.current_action = Action.DO_NOTHING
@@ -252,12 +342,12 @@ class PopAgent(Agent):
                 self.current_action = Action.DO_NOTHING
                 self.continue_action = during_of_action(self.current_action)
                 return
-            threshold = logistic_prob(factors=[1, 1, 1, 1, 1],
-                                      variables=[self.model.relationship_level[
-                                                     lower_first(self.unique_id, self.partner.unique_id)],
-                                                 1 - self.age / 100, 1 - self.partner.age / 100,
-                                                 sum([1 for k in [self.mask, self.partner.mask] if k]),
-                                                 1 - dist(self.pos, self.partner.pos) / np.sqrt(8)])
+            threshold = logistic_prob_normalized(weights=ACTION_WEIGHTS,
+                                                 variables=[self.model.relationship_level[
+                                                                lower_first(self.unique_id, self.partner.unique_id)],
+                                                            1 - self.age / 100, 1 - self.partner.age / 100,
+                                                            sum([1 for k in [self.mask, self.partner.mask] if k]),
+                                                            1 - dist(self.pos, self.partner.pos) / np.sqrt(8)])
 
             if 'back_seat_move' in move_path and self.close_to_seat():
                 prob = [0.7, 1]
@@ -287,30 +377,25 @@ class PopAgent(Agent):
         self.partner.continue_action = during_of_action(self.current_action)
 
     def close_to_seat(self):
-        return self.pos in self.model.grid.get_neighborhood(self.base_pos, moore=True, include_center=True,
-                                                            radius=1)
+        return self.pos in self.model.neighborhoods[1][self.base_pos]
 
     def contagious(self):
         # The current agent isn't contagious
         if self.health < HealthStatus.CARRIED:
             return
         # All the close cellmates
-        cellmates = [c for c in
-                     self.model.grid.get_cell_list_contents(self.model.grid.get_neighborhood(self.pos, moore=True,
-                                                                                             include_center=True,
-                                                                                             radius=1)) if
-                     type(c) != DrawingOnGridAgent]
+        cellmates = self.model.grid.get_cell_list_contents(self.model.neighborhoods[1][self.pos])
         for c in cellmates:
             # The cellmate is already contagious
             if c.health == HealthStatus.CARRIED and c.infection_generation <= self.infection_generation:
                 continue
             # Calculate the threshold for contagious, according to the parameters below
-            threshold = logistic_prob(factors=self.model.inf_coeff,
-                                      variables=[1 / np.sqrt(self.infection_generation),
-                                                 self.infects_others_level,
-                                                 c.infects_by_others_level,
-                                                 self.model.air_conditioning / AirStatus.AIR_RECYCLING],
-                                      expected_value=1)
+            threshold = logistic_prob_normalized(weights=self.model.inf_weights,
+                                                 variables=[1 / np.sqrt(self.infection_generation),
+                                                            self.infects_others_level,
+                                                            c.infects_by_others_level,
+                                                            self.model.air_conditioning / AirStatus.AIR_RECYCLING],
+                                                 expected_value=1)
 
             # Interaction
             if self.partner != self:
@@ -319,52 +404,62 @@ class PopAgent(Agent):
 
             # Mask reduction
             threshold *= mask_protection(self, c, self.model.infRate)
-            if throw_coin(threshold):
+            if throw_coin(threshold, self.model.rng):
+                new_case = c.health != HealthStatus.CARRIED
+                self.model.infections.record(self.model.time, self.unique_id, c.unique_id,
+                                             self.infection_generation + 1, self.current_action, self.mask, c.mask,
+                                             c.pos, self.infection_tick, new_case)
+                if new_case:
+                    c.infection_tick = self.model.time
                 c.health = HealthStatus.CARRIED
                 c.infection_generation = self.infection_generation + 1
+                if self.model.tracer is not None and self.model.tracer.sampled(self.unique_id):
+                    self.model.tracer.record(self.model.time, self.unique_id, INFECTION,
+                                             value=c.infection_generation, other=c.unique_id)
 
     def wear_mask(self, area_size, cellmates):
-        crowded = len(cellmates)
-        threshold = logistic_prob(factors=self.model.mask_coeff,
-                                  variables=[self.age / 100, self.social_influence,
-                                             crowded / area_size,
-                                             self.model.country_status / CountryStatus.HIGH_MORBIDITY,
-                                             self.model.air_conditioning / AirStatus.AIR_RECYCLING, ])
+        crowded = self.model.crowd.count(self.pos, radius=2)
+        threshold = logistic_prob_normalized(weights=self.model.mask_weights,
+                                             variables=[self.age / 100, self.social_influence,
+                                                        crowded / area_size,
+                                                        self.model.country_status / CountryStatus.HIGH_MORBIDITY,
+                                                        self.model.air_conditioning / AirStatus.AIR_RECYCLING, ])
         threshold *= influence_action_on_wearing_mask(self.current_action, self.model.conference)
 
-        if throw_coin(threshold):
+        if throw_coin(threshold, self.model.rng):
             self.mask = True
         else:
             self.mask = False
 
     def update_social_influence(self, cellmates):
-        wearing_mask = sum([self.model.relationship_level[lower_first(self.unique_id, c.unique_id)]
-                            if lower_first(self.unique_id, c.unique_id) != 0
-                            else 1 for c in cellmates if c.mask and c != self])
-        all = sum([self.model.relationship_level[lower_first(self.unique_id, c.unique_id)]
-                   if lower_first(self.unique_id, c.unique_id) != 0
-                   else 1 for c in cellmates if c != self])
+        others = [c for c in cellmates if c != self]
+        levels = self.model.relationship_level.lookup(self.unique_id, [c.unique_id for c in others])
+        wearing_mask = levels[np.array([c.mask for c in others], dtype=bool)].sum()
+        all = levels.sum()
         # The most of cellmates not wearing mask
         if wearing_mask < 0.5 * all:
-            self.social_influence = -1 * np.random.random() * (1 - self.age / 100) + 1 * np.random.random() * (
-                    self.age / 100)
+            self.social_influence = -1 * self.model.rng.random() * (1 - self.age / 100) + \
+                                    1 * self.model.rng.random() * (self.age / 100)
         else:
-            self.social_influence = np.random.normal(0.5, 0.2)
+            self.social_influence = self.model.rng.normal(0.5, 0.2)
 
     def choose_chair(self):
-        # Find the level of relationship between the agent and the agents around tables
-        contact_level_chair = [sum([self.model.relationship_level[lower_first(self.unique_id, k)]
-                                    for k in seat]) for seat in self.model.occupied_chairs if len(seat) <= 10]
-
-        x = self.random.choices([(seat, i) for i, seat in
-                                 enumerate(self.model.seating_area)
-                                 if len(self.model.occupied_chairs[i]) <= 10],
-                                weights=[prob / max(sum(contact_level_chair), 1) for prob in contact_level_chair])
-        self.base_pos = x[0][0]
-        self.model.occupied_chairs[x[0][1]].append(self.unique_id)
+        # Sit at a table that is not full, with probability by the level of relationship with the agents already
+        # seated around it (uniform when there is no relationship with any of them). No seat when all are full.
+        free = np.flatnonzero(self.model.table_occupancy < TABLE_SEATS)
+        if len(free) == 0:
+            return
+        weights = np.maximum(self.model.table_affinity(self.unique_id)[free], 0)
+        total = weights.sum()
+        if total > 0:
+            chosen = np.searchsorted(np.cumsum(weights), self.model.rng.random() * total, side='right')
+            table = free[min(chosen, len(free) - 1)]
+        else:
+            table = free[int(self.model.rng.random() * len(free))]
+        self.model.sit_down(self, table)
 
     def active_agent(self):
-        if throw_coin(self.model.arrival_rate) and not self.active:
+        if throw_coin(self.model.arrival_rate, self.model.rng) and not self.active:
             self.active = True
             if len(self.model.seating_area) > 0:
                 self.choose_chair()
@@ -373,16 +468,13 @@ class PopAgent(Agent):
     def step(self):
         if not self.active_agent():
             return
-        possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True,
-                                                          include_center=True,
-                                                          radius=2)
-        cellmates = [c for c in self.model.grid.get_cell_list_contents(possible_steps
-                                                                       ) if type(c) != DrawingOnGridAgent]
+        possible_steps = self.model.neighborhoods[2][self.pos]
+        cellmates = self.model.grid.get_cell_list_contents(possible_steps)
         if self.close_to_seat():
             self.last_time_in_seat = self.model.time
 
         # Continue the previous action
-        if throw_coin(self.continue_action):
+        if throw_coin(self.continue_action, self.model.rng):
             self.action_done = True
             self.partner.action_done = True
             self.continue_action *= during_of_action(self.current_action)
@@ -390,23 +482,121 @@ class PopAgent(Agent):
         # The agent has not performed any action yet
         if not self.action_done:
             decision_path = self.move(possible_steps, cellmates)
-            print(decision_path)
+            traced = self.model.tracer is not None and self.model.tracer.sampled(self.unique_id)
+            if traced and decision_path is not None:
+                self.model.tracer.record(self.model.time, self.unique_id, DECISION,
+                                         path=[self.model.move_decision_tree.index[n] for n in decision_path])
             if self.model.actions:
                 self.choose_action(decision_path, cellmates)
+                if traced:
+                    self.model.tracer.record(self.model.time, self.unique_id, ACTION, value=self.current_action,
+                                             other=self.partner.unique_id)
 
         self.update_social_influence(cellmates)
         self.wear_mask(len(possible_steps), cellmates)
-        self.contagious()
+        if not self.model.vectorized_contagion:
+            self.contagious()
+
+
+def vectorized_contagious(model: "CoronaCloseModel"):
+    # One infection pass of all the active carriers at once, the array version of PopAgent.contagious.
+    # All the pairs see the health of the start of the pass, a cellmate infected by some carriers
+    # gets the lowest generation among them.
+    store = model.agent_state
+    health = store.column('health')
+    generation = store.column('infection_generation')
+    carriers = np.flatnonzero((health == HealthStatus.CARRIED) & store.column('active'))
+    if len(carriers) == 0:
+        return
+    pos = store.column('pos')
+    carriers, cellmates = CellIndex(pos, model.grid.width, model.grid.height).neighbor_pairs(carriers, pos)
+
+    # The cellmate is already contagious
+    susceptible = ~((health[cellmates] == HealthStatus.CARRIED) & (generation[cellmates] <= generation[carriers]))
+    carriers, cellmates = carriers[susceptible], cellmates[susceptible]
+
+    threshold = logistic_prob_batch(weights=model.inf_weights,
+                                    variables=np.column_stack([1 / np.sqrt(generation[carriers]),
+                                                               store.column('infects_others_level')[carriers],
+                                                               store.column('infects_by_others_level')[cellmates],
+                                                               np.full(len(carriers), model.air_conditioning /
+                                                                       AirStatus.AIR_RECYCLING)]),
+                                    expected_value=1)
+
+    # Interaction
+    interaction = store.column('partner')[carriers] != carriers
+    action_factor = CONTAGIOUS_ACTION[store.column('current_action')[carriers]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        threshold = np.where(interaction,
+                             threshold * action_factor / ((1 - threshold) + threshold * action_factor),
+                             threshold)
+
+    # Mask reduction
+    mask = store.column('mask')
+    threshold = threshold * np.asarray(model.infRate)[MASK_PROTECTION_INDEX[mask[carriers].astype(np.int64) +
+                                                                            mask[cellmates]]]
+    infected = model.rng.random_array(len(threshold)) < threshold
+    if not infected.any():
+        return
+    carriers, cellmates = carriers[infected], cellmates[infected]
+    new_generation = np.full(store.size, np.iinfo(np.int32).max, dtype=np.int64)
+    np.minimum.at(new_generation, cellmates, generation[carriers] + 1)
+
+    # Every transmission is logged, for an agent that was not a carrier the one of the lowest generation
+    # (the generation it gets) is its new case
+    ids = store.column('unique_id')
+    infection_tick = store.column('infection_tick')
+    order = np.lexsort((generation[carriers], cellmates))
+    new_case = np.zeros(len(cellmates), dtype=bool)
+    new_case[order[np.unique(cellmates[order], return_index=True)[1]]] = True
+    new_case &= health[cellmates] != HealthStatus.CARRIED
+    model.infections.record_many(model.time, ids[carriers], ids[cellmates], generation[carriers] + 1,
+                                 store.column('current_action')[carriers], mask[carriers], mask[cellmates],
+                                 pos[cellmates], infection_tick[carriers], new_case)
+    infection_tick[cellmates[new_case]] = model.time
+    if model.tracer is not None:
+        model.tracer.record_many(model.time, ids[carriers], INFECTION, generation[carriers] + 1, ids[cellmates])
+    infected = np.flatnonzero(new_generation < np.iinfo(np.int32).max)
+    model.carried_count += int(np.count_nonzero(health[infected] != HealthStatus.CARRIED))
+    health[infected] = HealthStatus.CARRIED
+    generation[infected] = new_generation[infected]
+
+
+def update_friend_affinity(model: "CoronaCloseModel"):
+    # Average relationship level of every person with the people around each of its 25 possible steps, from the
+    # positions of the start of the tick: friend_affinity[row, dx + 2, dy + 2] is the affinity of the step
+    # (x + dx, y + dy). One pass over the couples of people within radius 3: their levels are summed into a 7 x 7
+    # window around every person and the 3 x 3 boxes of the window give the 5 x 5 steps.
+    # The people are the first num_agents rows of the agent state store, and their rows are their ids.
+    store = model.agent_state
+    pos = store.column('pos')[:model.num_agents]
+    people = np.flatnonzero(pos[:, 0] >= 0)
+    sources, neighbors = CellIndex(pos, model.grid.width, model.grid.height).neighbor_pairs(people, pos, radius=3)
+    others = sources != neighbors
+    sources, neighbors = sources[others], neighbors[others]
+    offset = pos[neighbors] - pos[sources] + 3
+    window = (sources * 7 + offset[:, 0]) * 7 + offset[:, 1]
+    size = model.num_agents * 49
+    levels = np.bincount(window, weights=model.relationship_level.lookup(sources, neighbors), minlength=size)
+    counts = np.bincount(window, minlength=size)
+    levels = box_sum_3(levels.reshape(-1, 7, 7))
+    counts = box_sum_3(counts.reshape(-1, 7, 7))
+    np.divide(levels, counts, out=model.friend_affinity[:model.num_agents], where=counts > 0)
+    model.friend_affinity[:model.num_agents][counts == 0] = 0
+
+
+def box_sum_3(windows):
+    # Sums of the 3 x 3 boxes of a stack of windows: (n, w, h) -> (n, w - 2, h - 2)
+    windows = windows[:, :-2] + windows[:, 1:-1] + windows[:, 2:]
+    return windows[:, :, :-2] + windows[:, :, 1:-1] + windows[:, :, 2:]
 
 
 def count_carried(model: "CoronaCloseModel"):
-    return len([1 for k in [a for a in model.schedule.agents
-                            if type(a) != DrawingOnGridAgent] if
-                k.health == HealthStatus.CARRIED])
+    return model.carried_count
 
 
 def count_mask(model: "CoronaCloseModel"):
-    return len([1 for k in model.schedule.agents if type(k) != DrawingOnGridAgent and k.mask])
+    return model.mask_count
 
 
 def move_forward(possible_steps, destination):
@@ -414,13 +604,13 @@ def move_forward(possible_steps, destination):
 
 
 def count_crowd(model):
-    return len([1 for k in model.schedule.agents if model.pos_in_gathering_area(k.pos)
-                and type(k) != DrawingOnGridAgent])
+    return model.crowd_count
 
 
 class WaiterAgent(PopAgent):
     def move(self, possible_steps, cellmates):
-        if throw_coin((self.model.time - self.last_time_in_seat) / (self.model.time + self.last_time_in_seat)):
+        if throw_coin((self.model.time - self.last_time_in_seat) / (self.model.time + self.last_time_in_seat),
+                      self.model.rng):
             new_position = move_forward(possible_steps, self.base_pos)
         else:
             new_position = move_forward(possible_steps, (self.model.grid.height, self.model.grid.width))
@@ -428,7 +618,7 @@ class WaiterAgent(PopAgent):
 
     def choose_action(self, move_path, cellmates):
         if self.close_to_seat():
-            if throw_coin(0.5):
+            if throw_coin(0.5, self.model.rng):
                 self.current_action = Action.TALKING
                 self.choose_interaction(cellmates)
                 self.partner.current_action = Action.TALKING
@@ -438,7 +628,7 @@ class WaiterAgent(PopAgent):
                 self.partner.continue_action = during_of_action(self.current_action, True)
 
     def wear_mask(self, area_size, cellmates):
-        if (self.close_to_seat() and throw_coin(0.9)) or throw_coin(0.7):
+        if (self.close_to_seat() and throw_coin(0.9, self.model.rng)) or throw_coin(0.7, self.model.rng):
             self.mask = True
         else:
             self.mask = False
@@ -448,53 +638,92 @@ class CoronaCloseModel(Model):
     def __init__(self, N: int, height: int, width: int, country_status: CountryStatus, air_condition: AirStatus,
                  inf_coeff=None, infRate=None, mask_coeff=None, entry_num=0, arrival_rate=0,
                  conference_area=None, relationship=False, get_away=False,
-                 tables=False, waiters=False, actions=False, *args: Any, **kwargs: Any, ):
+                 tables=False, waiters=False, actions=False, vectorized_contagion=False,
+                 collect_interval=1, collect_agents=False, tracer=None, profiler=None, *args: Any, **kwargs: Any, ):
         super().__init__(*args, **kwargs)
+        # Constructor arguments, for forking the model from a snapshot
+        self.params = dict(N=N, height=height, width=width, country_status=country_status,
+                           air_condition=air_condition, inf_coeff=inf_coeff, infRate=infRate, mask_coeff=mask_coeff,
+                           entry_num=entry_num, arrival_rate=arrival_rate, conference_area=conference_area,
+                           relationship=relationship, get_away=get_away, tables=tables, waiters=waiters,
+                           actions=actions, vectorized_contagion=vectorized_contagion,
+                           collect_interval=collect_interval, collect_agents=collect_agents)
         # Fixed system fields
         self.num_agents = N
         self.grid = MultiGrid(width, height, False)
+        # Moore neighborhoods (center included) of every cell, by radius, shared by all the models of this grid size
+        self.neighborhoods = {r: neighborhood_table(width, height, r) for r in (1, 2)}
         self.schedule = RandomActivation(self)
         self.running = True
         self.air_conditioning = air_condition
         self.country_status = country_status
         self.arrival_rate = arrival_rate
         self.get_away = get_away
+        self.relationship = relationship
         self.actions = actions
+        # Random numbers of the model, all from its seed: Mesa's Model.__new__ puts the seed and self.random on the
+        # class (shared by every live model), so the model keeps its own Python Random for the grid moves and the
+        # scheduler, and a RandomStream for the numpy draws
+        self._seed = kwargs.get('seed')
+        self.random = random.Random(self._seed)
+        self.rng = RandomStream(self._seed)
+        # Run the infection as one pass over all the carriers at the end of the step instead of agent by agent
+        self.vectorized_contagion = vectorized_contagion
+
+        # State of all the people agents (PopAgent and WaiterAgent), one row per agent
+        self.agent_state = AgentStateStore(capacity=N)
+        # Number of agents around every cell, updated when an agent is placed or moved
+        self.crowd = CrowdField(width, height)
+        # Running totals of carried agents, agents with mask and agents in the gathering area,
+        # updated by the health/mask/pos setters of the agents
+        self.carried_count = 0
+        self.mask_count = 0
+        self.crowd_count = 0
 
         self.gathering_area = {'min_x': conference_area[0], 'min_y': conference_area[1],
                                'max_x': conference_area[2],
                                'max_y': conference_area[3]}
         self.switch_time = max(conference_area[4], 1)
+        self.gathering_area_size = max(rect_area([k for k in self.gathering_area.values()]), 1)
         self.entry_list = [(0, 0), (0, width - 1), (height - 1, 0), (height, width)][0:entry_num]
 
+        # Static venue layers (indexed [x, y] like the grid): the gathering area and the cells of the tables
+        xs, ys = np.arange(width)[:, np.newaxis], np.arange(height)[np.newaxis, :]
+        self.gathering_layer = (self.gathering_area['min_x'] <= xs) & (xs <= self.gathering_area['max_x']) & \
+                               (self.gathering_area['min_y'] <= ys) & (ys <= self.gathering_area['max_y'])
+        self.table_layer = np.zeros((width, height), dtype=bool)
+        self.venue = VenueLayout(self.gathering_layer)
+
         # Changeable system fields
         self.time = 0
         self.conference = False
         self.conference_crowded = 0
-        self.save_seven_days_before = Queue(5)
+        # Every transmission of the run, R is calculated from it
+        self.infections = InfectionLog(window=5, cohorts=5)
         self.R = 0
 
         # Coefficients for logistic probability
         self.mask_coeff = mask_coeff
         self.inf_coeff = inf_coeff
         self.infRate = infRate
-
-        # Data Collectors
-        self.datacollector = DataCollector(
-            model_reporters={"Ills": count_carried},
-            agent_reporters={"Health": "health"})
-
-        self.datacollector_1 = DataCollector(
-            model_reporters={"Crowd": count_crowd},
-            agent_reporters={"Health": "health"})
-
-        self.datacollector_2 = DataCollector(
-            model_reporters={"Mask": count_mask},
-            agent_reporters={"Health": "health"})
-
-        self.datacollector_3 = DataCollector(
-            model_reporters={"R Coeff.": self.get_R},
-            agent_reporters={"Health": "health"})
+        # The same coefficients normalized once for the whole run
+        self.mask_weights = normalize_factors(mask_coeff)
+        self.inf_weights = normalize_factors(inf_coeff)
+        self.move_weights = normalize_factors([mask_coeff[0], mask_coeff[3]]) if mask_coeff is not None else None
+
+        # Data Collector: one column per series, every collect_interval steps
+        self.datacollector = SeriesCollector(
+            model_reporters={"Ills": count_carried, "Crowd": count_crowd, "Mask": count_mask,
+                             "R Coeff.": CoronaCloseModel.get_R},
+            agent_reporters={"Health": "health"} if collect_agents else None,
+            interval=collect_interval)
+
+        # generate_age draws from the global numpy state: with a seed, the agents are built with that state seeded
+        # from the model seed, and the caller gets its global state back afterwards
+        global_state = None
+        if self._seed is not None:
+            global_state = np.random.get_state()
+            np.random.seed(np.random.SeedSequence(self._seed).spawn(1)[0].generate_state(1)[0])
 
         # Init agents
         # Init carried agents
@@ -510,6 +739,8 @@ class CoronaCloseModel(Model):
                 y = self.random.randrange(0, self.grid.width)
                 self.grid.place_agent(a, (x, y))
 
+        self.infections.add_initial_cases(percent_ills)
+
         # Init healthy agents
         for i in range(percent_ills, self.num_agents):
             a = PopAgent(i, self)
@@ -521,26 +752,16 @@ class CoronaCloseModel(Model):
                 y = self.random.randrange(0, self.grid.width)
                 self.grid.place_agent(a, (x, y))
 
-        # Init gathering area agents for coloring
-        pos_in_gathering_area = [(i, j) for i in range(self.gathering_area['min_x'],
-                                                       self.gathering_area['max_x'])
-                                 for j in range(self.gathering_area['min_y'],
-                                                self.gathering_area['max_x'])]
-
-        for i, k in enumerate(pos_in_gathering_area):
-            a = DrawingOnGridAgent(i + self.num_agents * 2, self)
-            self.schedule.add(a)
-            self.grid.place_agent(a, k)
-
         # Init seating area
         self.seating_area = []
         if tables:
             self.init_seating_area()
-            self.occupied_chairs = [[] for i in range(len(self.seating_area))]
+        # Number of agents seated at every table
+        self.table_occupancy = np.zeros(len(self.seating_area), dtype=np.int64)
 
         # Init waiters
         if waiters and tables:
-            k = 3000
+            k = self.num_agents
             for i, table in enumerate(self.seating_area):
                 a = WaiterAgent(k + i, self)
                 self.schedule.add(a)
@@ -548,40 +769,53 @@ class CoronaCloseModel(Model):
                 a.base_pos = table
                 self.grid.place_agent(a, table)
 
+        if global_state is not None:
+            np.random.set_state(global_state)
+
         # Init relationship level between agents
         # If declare homogeneous relationship, then the relationship of each couple equal to 0
-        # else it define by number that distribute ~N(0.5,0.2)
-        self.relationship_level = dict()
-        people = [p for p in self.schedule.agents if type(p) != DrawingOnGridAgent]
-        for couple in combinations(people, 2):
-            if relationship and couple[0].unique_id < 3000 and couple[1].unique_id < 3000:
-                self.relationship_level[couple[0].unique_id, couple[1].unique_id] = np.random.normal(0.5, 0.2)
-            else:
-                self.relationship_level[couple[0].unique_id, couple[1].unique_id] = 0
+        # else it define by number that distribute ~N(0.5,0.2). Waiters have no relationships.
+        self.relationship_level = RelationshipStore(self.num_agents)
+        if relationship:
+            self.relationship_level.fill_normal(self.rng.generator, 0.5, 0.2)
+
+        # Friend affinity of every possible step of every person, updated at the start of every step
+        self.friend_affinity = np.zeros((self.agent_state.size, 5, 5))
 
         # Choose move policy
-        self.move_decision_tree = build_moving_decision_tree()
+        self.move_decision_tree = build_moving_decision_tree().compile()
+        self.move_threshold_providers = self.move_decision_tree.node_providers(MOVE_THRESHOLDS)
+
+        # Optional tracing.Tracer of decisions, actions and infections (None means no tracing)
+        self.tracer = tracer
+        if self.tracer is not None:
+            self.tracer.node_names = self.move_decision_tree.names
+
+        # Optional profiling.StepProfiler of the phases of the step (None means no profiling)
+        self.profiler = profiler
+        if self.profiler is not None:
+            self.profiler.instrument(self)
 
     def init_seating_area(self):
-        k = 2000
-        while len(self.seating_area) < int(self.num_agents / 10):
-            x = self.random.randrange(0, self.grid.height)
-            y = self.random.randrange(0, self.grid.width)
-            if self.pos_in_gathering_area((x, y)) \
-                    or len([1 for seat in self.seating_area
-                            if seat in self.grid.get_neighborhood((x, y),
-                                                                  moore=True, include_center=True, radius=3)]) > 0 \
-                    or x == 0 or y == 0 or x + 2 >= self.grid.height or y + 1 >= self.grid.width:
-                continue
-            self.seating_area.append((x, y))
-            a = DrawingOnGridAgent(k, self)
-            b = DrawingOnGridAgent(k + 1, self)
-            k += 2
-            self.schedule.add(a)
-            self.grid.place_agent(a, (x, y))
-            self.schedule.add(b)
-            self.grid.place_agent(b, (x + 1, y))
-        self.occupied_chairs = [10] * len(self.seating_area)
+        # One table per 10 agents, as many as fit out of the gathering area
+        self.seating_area = self.venue.place_tables(int(self.num_agents / 10), self.rng.generator)
+        for x, y in self.seating_area:
+            self.table_layer[x, y] = self.table_layer[x + 1, y] = True
+
+    def table_affinity(self, unique_id):
+        # Sum of the relationship levels of an agent with the agents seated at every table, one vectorized pass
+        # over the seated agents (their table is in the agent state store, and their rows are their ids)
+        if self.relationship_level.levels is None:
+            return np.zeros(len(self.seating_area))
+        tables = self.agent_state.column('table')
+        seated = np.flatnonzero(tables >= 0)
+        return np.bincount(tables[seated], weights=self.relationship_level.lookup(unique_id, seated),
+                           minlength=len(self.seating_area))
+
+    def sit_down(self, agent, table):
+        agent.base_pos = self.seating_area[table]
+        self.agent_state.table[agent.idx] = table
+        self.table_occupancy[table] += 1
 
     def pos_in_gathering_area(self, pos):
         x, y = pos
@@ -594,30 +828,144 @@ class CoronaCloseModel(Model):
     def get_R(self):
         return self.R
 
+    def recount(self):
+        # Recalculate the running totals from the agent state store
+        state = self.agent_state
+        self.carried_count = int(np.count_nonzero(state.column('health') == HealthStatus.CARRIED))
+        self.mask_count = int(np.count_nonzero(state.column('mask')))
+        pos = state.column('pos')
+        pos = pos[pos[:, 0] >= 0]
+        self.crowd_count = int(np.count_nonzero(self.gathering_layer[pos[:, 0], pos[:, 1]]))
+
+    def snapshot(self):
+        # Compact (compressed) bytes of the whole changeable state of the model: the agent arrays, the order of
+        # the agents in the grid cells, the venue, the relationship levels, the RNG states and the collected
+        # series. The tracer is not part of the snapshot.
+        grid_order = [agent.idx for column in self.grid.grid for cell in column for agent in cell]
+        state = {'params': self.params, 'seed': self._seed,
+                 'agents': self.agent_state.get_state(), 'grid_order': np.array(grid_order, dtype=np.int32),
+                 'seating_area': self.seating_area, 'table_layer': self.table_layer,
+                 'table_occupancy': self.table_occupancy,
+                 'relationship_level': self.relationship_level.get_state(),
+                 'time': self.time, 'conference': self.conference, 'conference_crowded': self.conference_crowded,
+                 'infections': self.infections.get_state(), 'R': self.R,
+                 'schedule': (self.schedule.steps, self.schedule.time),
+                 'random': self.random.getstate(), 'rng': self.rng.get_state(),
+                 'datacollector': self.datacollector.get_state()}
+        return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def fork(cls, snapshot: bytes, seed=None, tracer=None, profiler=None, **overrides):
+        # New model that continues from the snapshot, with some behavioural constructor arguments replaced
+        # (e.g. mask_coeff, inf_coeff or conference_area, not the ones of FORK_FIXED_PARAMS). With a seed the
+        # continuation draws other random numbers, without it the fork repeats the original run (for the same
+        # arguments).
+        fixed = [name for name in FORK_FIXED_PARAMS if name in overrides]
+        if len(fixed) > 0:
+            raise ValueError('A fork can not change {} of the snapshot'.format(', '.join(fixed)))
+        state = pickle.loads(zlib.decompress(snapshot))
+        params = dict(state['params'])
+        params.update(overrides)
+        model = cls(seed=state['seed'], tracer=tracer, profiler=profiler, **params)
+        model.restore(state)
+        if seed is not None:
+            model.reseed(seed)
+        return model
+
+    def restore(self, state):
+        # Load a snapshot state into a model that was built with the same number of agents
+        self.agent_state.set_state(state['agents'])
+        # Put the agents back in the grid cells in the order they had. The cell lists are written directly:
+        # place_agent would set the pos of every agent again, and the pos setter would update the crowd field one
+        # agent at a time, while the pos column already holds the cells and the field is rebuilt in one pass.
+        pos = self.agent_state.column('pos')
+        self.grid = MultiGrid(self.grid.width, self.grid.height, False)
+        for idx in state['grid_order']:
+            x, y = pos[idx].tolist()
+            self.grid.grid[x][y].append(self.agent_state.agents[idx])
+        self.grid.empties.difference_update(map(tuple, pos[state['grid_order']].tolist()))
+        self.crowd.rebuild(pos)
+        self.recount()
+
+        self.seating_area = state['seating_area']
+        self.table_layer = state['table_layer']
+        self.table_occupancy = state['table_occupancy']
+        self.relationship_level.set_state(state['relationship_level'])
+
+        self.time = state['time']
+        self.conference = state['conference']
+        self.conference_crowded = state['conference_crowded']
+        self.infections.set_state(state['infections'])
+        self.R = state['R']
+        self.schedule.steps, self.schedule.time = state['schedule']
+        self.random.setstate(state['random'])
+        self.rng.set_state(state['rng'])
+        self.datacollector.set_state(state['datacollector'])
+
+    def reseed(self, seed):
+        self._seed = seed
+        self.random = random.Random(seed)
+        self.rng = RandomStream(seed)
+
+    def pair_agents(self, rows, ranks=None, start_action=None):
+        # Choose the partners of many agents at once, like PopAgent.choose_interaction: rows of the agent state
+        # store in the order they choose (that are not in an action), partners among the agents in their radius 2
+        # neighborhood that are not in an action. Sets the partner column of both sides in the order of the rows,
+        # start_action(row, partner) tells whether the couple starts an action (and leaves the pool, as
+        # choose_action sets action_done), without it every couple does. With the same ranks, positions and
+        # action_done this gives the partners of the choose_interaction calls of the rows in turn.
+        # Returns the partner of every row (itself if it found nobody, -1 if it was in an action).
+        store = self.agent_state
+        rows = np.asarray(rows, dtype=np.int64)
+        if ranks is None:
+            ranks = self.rng.generator.geometric(0.5, len(rows)) - 1
+        pos = store.column('pos')
+        sources, candidates = CellIndex(pos, self.grid.width, self.grid.height).neighbor_pairs(rows, pos, radius=2)
+        ids = store.column('unique_id')
+        levels = self.relationship_level.lookup(ids[sources], ids[candidates])
+
+        def pair(row, partner):
+            store.partner[row] = partner
+            store.partner[partner] = row
+            if partner == row:
+                return False
+            return True if start_action is None else bool(start_action(row, partner))
+
+        return batch_partners(sources, candidates, levels, rows, ranks, ~store.column('action_done'), pair)
+
     def clean_done_actions(self):
-        for agent in self.schedule.agents:
-            if type(agent) != DrawingOnGridAgent:
-                agent.action_done = False
+        self.agent_state.column('action_done')[:] = False
 
     def cal_R(self):
-        if len(self.save_seven_days_before.queue) > 0:
-            if self.save_seven_days_before.queue[0] > 0:
-                self.R = count_carried(self) / self.save_seven_days_before.queue[0]
+        # Mean number of new cases caused in the 5 ticks from the infection (the infection tick included), by the
+        # cases of the last 5 ticks whose 5 ticks are over (from the infection log)
+        self.R = self.infections.reproduction_number(self.time)
+
+    def run_phase(self, phase, function):
+        # Run a phase of the step (a function of the model), timed when there is a profiler
+        if self.profiler is None:
+            function(self)
+        else:
+            self.profiler.run(phase, function, self)
 
     def step(self) -> None:
         self.time += 1
+        if self.profiler is not None:
+            self.profiler.begin_tick(self.time)
         if self.time % self.switch_time == 0 and self.gathering_area['max_x'] > 0:
             self.change_conference()
-        self.save_seven_days_before.insert(count_carried(self))
-        self.cal_R()
         self.conference_crowded = count_crowd(self)
+        if self.relationship:
+            self.run_phase('friend_affinity', update_friend_affinity)
         self.schedule.step()
+        if self.vectorized_contagion:
+            self.run_phase('vectorized_contagion', vectorized_contagious)
+        self.cal_R()
         self.datacollector.collect(self)
-        self.datacollector_1.collect(self)
-        self.datacollector_2.collect(self)
-        self.datacollector_3.collect(self)
         if self.actions:
             self.clean_done_actions()
+        if self.profiler is not None:
+            self.profiler.end_tick()
 
 
 #
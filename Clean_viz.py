@@ -1,12 +1,15 @@
 import matplotlib
 
 from CleanCloseCorona import *
+from replicas import REPLICA_SERIES, aggregate_replicas, ProgressReporter
+from export import ColumnarExporter, export_aggregate
 from mesa.visualization.modules import CanvasGrid, ChartModule
 from mesa.visualization.ModularVisualization import ModularServer
 import PySimpleGUIWeb as sg
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.pyplot as plt
 import io
+import math
 import time
 
 
@@ -18,77 +21,75 @@ results_names = {
 
 
 def agent_portrayal(agent):
-    if type(agent) == DrawingOnGridAgent:
-        portrayal = {"Shape": "rect",
+    if type(agent) == PopAgent:
+        portrayal = {"Shape": "circle",
                      "Filled": "true",
-                     "h": 1, "w": 1}
-        if agent.model.pos_in_gathering_area(agent.pos) and agent.model.conference:
-            portrayal['Color'] = '#550000'
-            portrayal['Layer'] = 0
-        elif agent.pos in agent.model.seating_area:
-            portrayal['Color'] = '#000055'
-            portrayal['Layer'] = 0
-        else:
-            portrayal['Color'] = '#FFFFFF'
-            portrayal['Layer'] = 0
+                     "r": 0.5}
     else:
-        if type(agent) == PopAgent:
-            portrayal = {"Shape": "circle",
-                         "Filled": "true",
-                         "r": 0.5}
+        portrayal = {"Shape": "rect",
+                     "Filled": "true",
+                     "h": 0.5, "w": 0.5}
+    if not agent.active:
+        portrayal['Color'] = '#FFFFFF'
+        portrayal['Layer'] = 1
+    elif agent.health == HealthStatus.HEALTHY:
+        portrayal['Color'] = '#00FF00'
+        portrayal['Layer'] = 1
+    elif agent.health == HealthStatus.RECOVERY:
+        portrayal['Color'] = '#00FF00'
+        portrayal['Layer'] = 2
+    elif agent.health == HealthStatus.CARRIED:
+        if agent.infection_generation == 1:
+            portrayal['Color'] = '#FF0000'
+            portrayal['Layer'] = 3
         else:
-            portrayal = {"Shape": "rect",
-                         "Filled": "true",
-                         "h": 0.5, "w": 0.5}
-        if not agent.active:
-            portrayal['Color'] = '#FFFFFF'
-            portrayal['Layer'] = 1
-        elif agent.health == HealthStatus.HEALTHY:
-            portrayal['Color'] = '#00FF00'
-            portrayal['Layer'] = 1
-        elif agent.health == HealthStatus.RECOVERY:
-            portrayal['Color'] = '#00FF00'
-            portrayal['Layer'] = 2
-        elif agent.health == HealthStatus.CARRIED:
-            if agent.infection_generation == 1:
-                portrayal['Color'] = '#FF0000'
-                portrayal['Layer'] = 3
-            else:
-                portrayal['Color'] = '#FF00FF'
-                portrayal['Layer'] = 3
+            portrayal['Color'] = '#FF00FF'
+            portrayal['Layer'] = 3
 
     return portrayal
 
 
-def run_avg_sim(model: CoronaCloseModel, num_of_simulations: int, during_of_simulation: int, data_avg, data_var,
-                start_hour):
-    ills = data_avg[0]
-    conference = data_avg[1]
-    mask = data_avg[2]
-
-    ills_var = data_var[0]
-    conference_var = data_var[1]
-    mask_var = data_var[2]
-
-    avg_time_for_step = 0
-    for i in range(during_of_simulation):
-        start = time.time()
-        model.step()
-        # Average
-        ills[i] += count_carried(model) / num_of_simulations
-        conference[i] += count_crowd(model) / num_of_simulations
-        mask[i] += count_mask(model) / num_of_simulations
-
-        # Variance
-        ills_var[i] += count_carried(model)**2 / num_of_simulations
-        conference_var[i] += count_crowd(model)**2 / num_of_simulations
-        mask_var[i] += count_mask(model)**2 / num_of_simulations
+class VenueCanvasGrid(CanvasGrid):
+    # Draws the static venue layers of the model (gathering area and tables) under the agents
+    def render(self, model):
+        grid_state = super().render(model)
+        venue = model.table_layer.copy()
+        if model.conference:
+            venue |= model.gathering_layer
+        for x, y in zip(*np.nonzero(venue)):
+            portrayal = {"Shape": "rect",
+                         "Filled": "true",
+                         "h": 1, "w": 1,
+                         "x": int(x), "y": int(y),
+                         "Layer": 0}
+            if model.conference and model.gathering_layer[x, y]:
+                portrayal['Color'] = '#550000'
+            else:
+                portrayal['Color'] = '#000055'
+            grid_state[0].append(portrayal)
+        return grid_state
+
+
+class GuiProgress(ProgressReporter):
+    # One window with the finish time, updated in place
+    def __init__(self, min_interval=1.0):
+        super().__init__(min_interval)
+        self.window = None
+
+    def report(self, done: int, total: int, eta: float):
+        if eta == math.inf:
+            return
+        finish_at = time.localtime(time.time() + eta)
+        text = 'Finish Time:' + str(finish_at.tm_hour) + ':' + str(finish_at.tm_min) + ':' + str(finish_at.tm_sec)
+        if self.window is None:
+            self.window = sg.Window("Corona Simulation", [[sg.Text(text, key='-FINISH-')]], finalize=True)
+        else:
+            self.window['-FINISH-'].update(text)
 
-        avg_time_for_step = avg_time_for_step * i / (i + 1) + (time.time() - start) * 1 / (i + 1)
-        finish_at = time.localtime(start_hour + num_of_simulations * during_of_simulation * avg_time_for_step)
-        sg.Window("Corona Simulation", [[sg.Text('Finish Time:' + str(finish_at.tm_hour)
-                                                 + ':' + str(finish_at.tm_min) + ':' +
-                                                 str(finish_at.tm_sec))]]).show()
+    def finish(self):
+        if self.window is not None:
+            self.window.close()
+            self.window = None
 
 
 def draw_figure(canvas, figure):
@@ -128,25 +129,38 @@ def show_avg_graphs(figs):
 def run_sim(num_agents: int, height: int, width: int, country_status: CountryStatus, air_condition: AirStatus,
             inf_coeff=None, infRate=None, mask_coeff=None, show_online_data=None, entry_num=0, arrival_rate=0,
             conference_area=None, relationship=False, get_away=False, tables=False, waiters=False, actions=False,
-            avg_sim=False, num_sim=10, during_sim=30):
+            avg_sim=False, num_sim=10, during_sim=30, vectorized_contagion=False, processes=None,
+            progress=None, export_dir=None, seed=None):
     if avg_sim:
-        data_avg = [np.zeros(during_sim) for i in range(3)]
-        data_var = [np.zeros(during_sim) for i in range(3)]
-        start_hour = time.time()
-        for i in range(num_sim):
-            model = CoronaCloseModel(N=num_agents, width=width, height=height, inf_coeff=inf_coeff,
-                                     infRate=infRate, mask_coeff=mask_coeff,
-                                     entry_num=entry_num, country_status=country_status, air_condition=air_condition,
-                                     get_away=get_away, conference_area=conference_area, relationship=relationship,
-                                     tables=tables, waiters=waiters, actions=actions, arrival_rate=arrival_rate)
-            run_avg_sim(model, num_sim, during_sim, data_avg, data_var, start_hour)
-
+        model_params = dict(N=num_agents, width=width, height=height, inf_coeff=inf_coeff,
+                            infRate=infRate, mask_coeff=mask_coeff,
+                            entry_num=entry_num, country_status=country_status, air_condition=air_condition,
+                            get_away=get_away, conference_area=conference_area, relationship=relationship,
+                            tables=tables, waiters=waiters, actions=actions, arrival_rate=arrival_rate,
+                            vectorized_contagion=vectorized_contagion)
+        # The series are counts of agents (waiters included)
+        value_range = (0, num_agents + (num_agents // 10 if tables and waiters else 0) + 1)
+        if progress is None:
+            progress = GuiProgress()
+        # Optional columnar export of the results: the replicas and their aggregate
+        exporter = ColumnarExporter(export_dir) if export_dir is not None else None
+        # The replicas, across a process pool (processes=None means all the cores, 1 runs them in this process)
+        aggregator = aggregate_replicas(model_params, num_sim, during_sim, value_range, processes=processes,
+                                        seed=seed, progress=progress, exporter=exporter)
+        if exporter is not None:
+            export_aggregate(exporter, aggregator, [reporter.__name__ for reporter in REPLICA_SERIES],
+                             attrs={'params': model_params})
+            exporter.close()
+
+        p10, p50, p90 = aggregator.quantile(0.1), aggregator.quantile(0.5), aggregator.quantile(0.9)
         figs = []
-        for j, (avg, var) in enumerate(zip(data_avg, data_var)):
+        for j in range(len(REPLICA_SERIES)):
             fig = matplotlib.figure.Figure(figsize=(5, 4), dpi=100)
-            # fig.add_subplot(111).plot(list(range(during_sim)), k)
-            fig.add_subplot(111).errorbar(list(range(during_sim)), avg,
-                                          yerr=[np.sqrt(v - a**2) for a, v in zip(avg, var)])
+            ax = fig.add_subplot(111)
+            ax.fill_between(list(range(during_sim)), p10[j], p90[j], alpha=0.2, label='P10-P90')
+            ax.plot(list(range(during_sim)), p50[j], linestyle='--', label='P50')
+            ax.errorbar(list(range(during_sim)), aggregator.mean[j], yerr=aggregator.std[j], label='Mean')
+            ax.legend()
             figs.append((results_names[j + 1], fig))
         show_avg_graphs(figs)
         return
@@ -157,16 +171,16 @@ def run_sim(num_agents: int, height: int, width: int, country_status: CountrySta
 
               ChartModule([{"Label": "Crowd",
                             "Color": "Black"}],
-                          data_collector_name='datacollector_1'),
+                          data_collector_name='datacollector'),
 
               ChartModule([{"Label": "Mask",
                             "Color": "green"}],
-                          data_collector_name='datacollector_2'),
+                          data_collector_name='datacollector'),
               ChartModule([{"Label": "R Coeff.",
                             "Color": "orange"}],
-                          data_collector_name='datacollector_3'),]
+                          data_collector_name='datacollector'),]
 
-    grid = CanvasGrid(agent_portrayal, height, width, 400, 400)
+    grid = VenueCanvasGrid(agent_portrayal, height, width, 400, 400)
     chart_list = [grid] + [chart for chart, cbox in zip(charts, show_online_data) if cbox == 1]
 
     server = ModularServer(CoronaCloseModel,
@@ -177,7 +191,7 @@ def run_sim(num_agents: int, height: int, width: int, country_status: CountrySta
                             'inf_coeff': inf_coeff, 'infRate': infRate, 'mask_coeff': mask_coeff,
                             'entry_num': entry_num, 'arrival_rate': arrival_rate, 'conference_area': conference_area,
                             'relationship': relationship, 'get_away': get_away, 'tables': tables, 'waiters': waiters,
-                            'actions': actions})
+                            'actions': actions, 'vectorized_contagion': vectorized_contagion})
 
     server.port = 8521  # The default
     server.launch()
@@ -202,56 +202,58 @@ layout = [[sg.Column(general + probability_of_influence_without_mask + probabili
                      probability_of_wearing_mask),
            sg.Column(constrains + which_data_to_show + send_button + run_avg_simulation)]]
 
-window = sg.Window("Corona Simulation", layout)
-
-
 def input_check():
     for value in values:
         if values[value] == '':
             values[value] = default_dict[value]
 
 
-while True:
-    event, values = window.read()
-    if event == '-SUBMIT-' or event == '-SUBMIT_AVG-':
-        input_check()
-
-        if values['countryStatus'][0] is None:
-            values['countryStatus'][0] = 'Low morbidity'
-        if values['airCondition'][0] is None:
-            values['airCondition'][0] = 'Exchange'
-
-        infection = [float(values['infectGenerationW']), float(values['infectsOthersW']),
-                     float(values['infectedByOthersW']), float(values['airConditionW'])]
-
-        infRate = [float(values['bothMaskInfection']), float(values['oneMaskInfectionI']),
-                   float(values['oneMaskInfectionI']), default_dict['noMaskInfection']]
-
-        mask_coeff = [float(values['wearMaskAgeW']), float(values['wearMaskSocialInfW']),
-                      float(values['wearMaskCrowdingW']), float(values['wearMaskCountryStatusW']),
-                      float(values['wearMaskAirCondition'])]
-
-        conference_area = [int(k) for k in values['conference_area'].split()]
-        constrains = [float(values['entryNum']), float(values['arrivalRate']),
-                      conference_area, values['tables'],
-                      values['waiters'], values['actions']]
-
-        show_online_data = [float(values['numOfIllsCB']),
-                            float(values['RmeanCB']),
-                            float(values['gatheringAreaCB']),
-                            float(values['wearingMaskCB'])]
-
-        run_sim(num_agents=int(values['-numOfAgents-']), height=int(values['-Height-']), width=int(values['-width-']),
-                country_status=default_dict[values['countryStatus'][0]],
-                air_condition=default_dict[values['airCondition'][0]], inf_coeff=infection, infRate=infRate,
-                mask_coeff=mask_coeff, show_online_data=show_online_data, entry_num=int(values['entryNum']),
-                arrival_rate=float(values['arrivalRate']), conference_area=conference_area,
-                relationship=values['relationship'], get_away=values['getAwayFromCrowd'], tables=values['tables'],
-                waiters=values['waiters'], actions=values['actions'], avg_sim=(event == '-SUBMIT_AVG-'),
-                num_sim=int(values['numberOfSim']), during_sim=int(values['duringOfSim'])
-                )
-        break
-    if event == "Exit" or event == sg.WIN_CLOSED:
-        break
-
-window.close()
+# The averaged simulation starts worker processes that re-import this module (spawn start method),
+# so the window is opened only in the main process
+if __name__ == '__main__':
+    window = sg.Window("Corona Simulation", layout)
+
+    while True:
+        event, values = window.read()
+        if event == '-SUBMIT-' or event == '-SUBMIT_AVG-':
+            input_check()
+
+            if values['countryStatus'][0] is None:
+                values['countryStatus'][0] = 'Low morbidity'
+            if values['airCondition'][0] is None:
+                values['airCondition'][0] = 'Exchange'
+
+            infection = [float(values['infectGenerationW']), float(values['infectsOthersW']),
+                         float(values['infectedByOthersW']), float(values['airConditionW'])]
+
+            infRate = [float(values['bothMaskInfection']), float(values['oneMaskInfectionI']),
+                       float(values['oneMaskInfectionI']), default_dict['noMaskInfection']]
+
+            mask_coeff = [float(values['wearMaskAgeW']), float(values['wearMaskSocialInfW']),
+                          float(values['wearMaskCrowdingW']), float(values['wearMaskCountryStatusW']),
+                          float(values['wearMaskAirCondition'])]
+
+            conference_area = [int(k) for k in values['conference_area'].split()]
+            constrains = [float(values['entryNum']), float(values['arrivalRate']),
+                          conference_area, values['tables'],
+                          values['waiters'], values['actions']]
+
+            show_online_data = [float(values['numOfIllsCB']),
+                                float(values['RmeanCB']),
+                                float(values['gatheringAreaCB']),
+                                float(values['wearingMaskCB'])]
+
+            run_sim(num_agents=int(values['-numOfAgents-']), height=int(values['-Height-']), width=int(values['-width-']),
+                    country_status=default_dict[values['countryStatus'][0]],
+                    air_condition=default_dict[values['airCondition'][0]], inf_coeff=infection, infRate=infRate,
+                    mask_coeff=mask_coeff, show_online_data=show_online_data, entry_num=int(values['entryNum']),
+                    arrival_rate=float(values['arrivalRate']), conference_area=conference_area,
+                    relationship=values['relationship'], get_away=values['getAwayFromCrowd'], tables=values['tables'],
+                    waiters=values['waiters'], actions=values['actions'], avg_sim=(event == '-SUBMIT_AVG-'),
+                    num_sim=int(values['numberOfSim']), during_sim=int(values['duringOfSim'])
+                    )
+            break
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            break
+
+    window.close()
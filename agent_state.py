@@ -0,0 +1,105 @@
+import numpy as np
+
+# Columns of the agent state store: name -> (dtype, shape of one entry)
+AGENT_FIELDS = {
+    # Fixed fields
+    'unique_id': (np.int64, ()),
+    'age': (np.float64, ()),
+    'infects_others_level': (np.float64, ()),
+    'infects_by_others_level': (np.float64, ()),
+
+    # Changeable fields
+    'health': (np.int8, ()),
+    'mask': (np.bool_, ()),
+    'social_influence': (np.float64, ()),
+    'infection_generation': (np.int32, ()),
+    # Tick of the infection, 0 for the initial carriers and -1 for agents that were never infected
+    'infection_tick': (np.int64, ()),
+    'active': (np.bool_, ()),
+
+    # Table fields
+    'base_pos': (np.int32, (2,)),
+    'table': (np.int32, ()),
+    'last_time_in_seat': (np.int64, ()),
+
+    # Action and Interactions fields
+    'current_action': (np.int8, ()),
+    'continue_action': (np.float64, ()),
+    'partner': (np.int32, ()),
+    'action_done': (np.bool_, ()),
+
+    # Grid position, (-1, -1) means the agent is not on the grid
+    'pos': (np.int32, (2,)),
+}
+
+
+class AgentStateStore:
+    # Struct of arrays that holds the state of every PopAgent/WaiterAgent of one model.
+    # Agents are views on one row (their idx), so reporters and batch kernels can read the columns directly.
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.capacity = max(int(capacity), 1)
+        self.agents = []
+        for name, (dtype, shape) in AGENT_FIELDS.items():
+            setattr(self, name, np.zeros((self.capacity,) + shape, dtype=dtype))
+        self.pos.fill(-1)
+        self.table.fill(-1)
+
+    def allocate(self, agent):
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+        idx = self.size
+        self.size += 1
+        self.agents.append(agent)
+        self.partner[idx] = idx
+        return idx
+
+    def _grow(self, capacity):
+        for name in AGENT_FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.pos[self.size:] = -1
+        self.table[self.size:] = -1
+        self.capacity = capacity
+
+    def column(self, name):
+        # The used part of a column (a view, not a copy)
+        return getattr(self, name)[:self.size]
+
+    def get_state(self):
+        # Copy of the used part of every column, for model snapshots
+        return {name: self.column(name).copy() for name in AGENT_FIELDS}
+
+    def set_state(self, state):
+        # Overwrite the columns of the allocated agents, the store must hold the same number of agents
+        for name in AGENT_FIELDS:
+            if len(state[name]) != self.size:
+                raise ValueError('The state has {} agents, the store has {}'.format(len(state[name]), self.size))
+            self.column(name)[:] = state[name]
+
+
+def state_field(name, cast):
+    # Property that reads/writes one cell of the model's agent state store
+    def fget(agent):
+        return cast(getattr(agent.model.agent_state, name)[agent.idx])
+
+    def fset(agent, value):
+        getattr(agent.model.agent_state, name)[agent.idx] = value
+
+    return property(fget, fset)
+
+
+def state_pos_field(name):
+    # Property for (x, y) columns, None is stored as (-1, -1)
+    def fget(agent):
+        x, y = getattr(agent.model.agent_state, name)[agent.idx]
+        if x < 0:
+            return None
+        return int(x), int(y)
+
+    def fset(agent, value):
+        getattr(agent.model.agent_state, name)[agent.idx] = (-1, -1) if value is None else value
+
+    return property(fget, fset)
@@ -0,0 +1,123 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from CleanCloseCorona import CoronaCloseModel, CountryStatus, AirStatus
+from profiling import StepProfiler
+
+# Feature flags of every benchmark profile (the flags that are not listed are off)
+PROFILES = {
+    'base': dict(),
+    'conference': dict(conference=True),
+    'get_away': dict(get_away=True),
+    'relationship': dict(relationship=True),
+    'actions': dict(actions=True),
+    'tables': dict(tables=True),
+    'waiters': dict(tables=True, waiters=True),
+    'vectorized': dict(vectorized_contagion=True),
+    'all': dict(conference=True, get_away=True, relationship=True, actions=True, tables=True, waiters=True),
+}
+
+
+def model_params(num_agents: int, size: int, flags: dict):
+    # CoronaCloseModel arguments of one configuration, a size x size grid with the conference area in its middle
+    conference_area = [size // 4, size // 4, size * 3 // 4, size * 3 // 4, 3] if flags.get('conference') \
+        else [0, 0, 0, 0, 0]
+    return dict(N=num_agents, height=size, width=size, country_status=CountryStatus.MIDDLE_MORBIDITY,
+                air_condition=AirStatus.STANDING_AIR, inf_coeff=[1, 1, 1, 1], infRate=[0.1, 0.25, 0.25, 1],
+                mask_coeff=[1, 1, 1, 1, 1], entry_num=0, arrival_rate=1, conference_area=conference_area,
+                relationship=flags.get('relationship', False), get_away=flags.get('get_away', False),
+                tables=flags.get('tables', False), waiters=flags.get('waiters', False),
+                actions=flags.get('actions', False), vectorized_contagion=flags.get('vectorized_contagion', False))
+
+
+def peak_memory(params: dict, steps: int, seed=0):
+    # Peak of traced memory after the construction and after the steps of one configuration, in a run of its own:
+    # tracemalloc slows Python code down several times, so the timings are never taken from a traced run
+    tracemalloc.start()
+    try:
+        model = CoronaCloseModel(seed=seed, **params)
+        construction_peak = tracemalloc.get_traced_memory()[1]
+        for i in range(steps):
+            model.step()
+        return construction_peak, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(num_agents: int, size: int, profile: str, steps: int, seed=0, memory=False, phases=False):
+    # Construction time and step latencies of one configuration, with memory the peaks of traced memory as well
+    # (from a second, traced run of the same seed). With phases the seconds and calls of every step phase are
+    # added (from a StepProfiler).
+    params = model_params(num_agents, size, PROFILES[profile])
+    profiler = StepProfiler() if phases else None
+    started = time.perf_counter()
+    model = CoronaCloseModel(seed=seed, profiler=profiler, **params)
+    construction = time.perf_counter() - started
+
+    latencies = np.zeros(steps)
+    for i in range(steps):
+        started = time.perf_counter()
+        model.step()
+        latencies[i] = time.perf_counter() - started
+    construction_peak, peak = peak_memory(params, steps, seed) if memory else (None, None)
+
+    result = {'N': num_agents, 'size': size, 'profile': profile, 'flags': PROFILES[profile], 'steps': steps,
+              'seed': seed, 'construction_seconds': construction,
+              'step_mean_seconds': float(latencies.mean()), 'step_p50_seconds': float(np.percentile(latencies, 50)),
+              'step_p95_seconds': float(np.percentile(latencies, 95)), 'step_max_seconds': float(latencies.max()),
+              'steps_per_second': float(steps / latencies.sum()), 'memory_measured': memory,
+              'construction_peak_bytes': construction_peak, 'peak_bytes': peak,
+              'carried': model.carried_count}
+    if profiler is not None:
+        result['phases'] = {phase: {'seconds': seconds, 'calls': calls}
+                            for phase, (seconds, calls) in profiler.totals().items()}
+    return result
+
+
+def environment():
+    # Recorded with every result, so runs of different versions and machines can be told apart
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'node': platform.node()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark of CoronaCloseModel, writes JSON lines')
+    parser.add_argument('--agents', type=int, nargs='+', default=[200, 1000, 5000])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[30, 60, 120])
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--memory', action='store_true',
+                        help='Measure the peak memory too, in a second traced run of every configuration')
+    parser.add_argument('--phases', action='store_true', help='Record the time of every step phase')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args()
+
+    env = environment()
+    with open(args.output, 'a') as f:
+        for num_agents, size, profile, repeat in itertools.product(args.agents, args.sizes, args.profiles,
+                                                                   range(args.repeats)):
+            result = benchmark(num_agents, size, profile, args.steps, seed=repeat, memory=args.memory,
+                               phases=args.phases)
+            result.update(env)
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            print('N={N} size={size} {profile}: construction {construction_seconds:.3f}s, '
+                  '{steps_per_second:.1f} steps/s, p95 step {step_p95_seconds:.4f}s'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class SeriesCollector:
+    # Collects model series (label -> function of the model) and agent series (label -> column of the
+    # agent state store) into preallocated NumPy columns, every `interval` calls of collect.
+    # model_vars keeps the DataCollector interface that the ChartModules read from.
+    def __init__(self, model_reporters=None, agent_reporters=None, interval=1, capacity=64):
+        self.model_reporters = dict() if model_reporters is None else dict(model_reporters)
+        self.agent_reporters = dict() if agent_reporters is None else dict(agent_reporters)
+        self.interval = max(int(interval), 1)
+        self.capacity = max(int(capacity), 1)
+        self.size = 0
+        self.calls = 0
+        self.ticks = np.zeros(self.capacity, dtype=np.int64)
+        self.model_columns = {label: np.zeros(self.capacity) for label in self.model_reporters}
+        # Allocated on the first collect, when the number of agents is known
+        self.agent_columns = dict()
+
+    def collect(self, model):
+        self.calls += 1
+        if (self.calls - 1) % self.interval != 0:
+            return
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+        self.ticks[self.size] = model.time
+        for label, reporter in self.model_reporters.items():
+            self.model_columns[label][self.size] = reporter(model)
+        for label, field in self.agent_reporters.items():
+            values = model.agent_state.column(field)
+            if label not in self.agent_columns:
+                self.agent_columns[label] = np.zeros((self.capacity, len(values)), dtype=values.dtype)
+            self.agent_columns[label][self.size] = values
+        self.size += 1
+
+    def _grow(self, capacity):
+        ticks = np.zeros(capacity, dtype=np.int64)
+        ticks[:self.size] = self.ticks[:self.size]
+        self.ticks = ticks
+        for columns in (self.model_columns, self.agent_columns):
+            for label, column in columns.items():
+                new = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+                new[:self.size] = column[:self.size]
+                columns[label] = new
+        self.capacity = capacity
+
+    def get_state(self):
+        # Copy of the collected samples, for model snapshots
+        return {'calls': self.calls, 'ticks': self.get_ticks().copy(),
+                'model_columns': {label: column.copy() for label, column in self.model_vars.items()},
+                'agent_columns': {label: self.get_agent_vars(label).copy() for label in self.agent_columns}}
+
+    def set_state(self, state):
+        # Replace the collected samples, series that this collector does not report are dropped
+        size = len(state['ticks'])
+        self.size = 0
+        self._grow(max(self.capacity, size))
+        self.calls = state['calls']
+        self.ticks[:size] = state['ticks']
+        for label, column in self.model_columns.items():
+            column[:size] = state['model_columns'].get(label, 0)
+        self.agent_columns = dict()
+        for label, values in state['agent_columns'].items():
+            if label in self.agent_reporters:
+                self.agent_columns[label] = np.zeros((self.capacity,) + values.shape[1:], dtype=values.dtype)
+                self.agent_columns[label][:size] = values
+        self.size = size
+
+    @property
+    def model_vars(self):
+        return {label: column[:self.size] for label, column in self.model_columns.items()}
+
+    def get_ticks(self):
+        return self.ticks[:self.size]
+
+    def get_agent_vars(self, label):
+        # Matrix of samples x agents (rows of the agent state store)
+        return self.agent_columns[label][:self.size]
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.model_vars, index=pd.Index(self.get_ticks(), name='Step'))
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+
+import numpy as np
+
+from agent_state import AGENT_FIELDS
+
+MANIFEST = 'manifest.json'
+
+
+class ColumnarExporter:
+    # Writes datasets of columns to a directory: one .npy file per column and chunk, and manifest.json that lists
+    # every dataset with its chunks (number of rows and the file of every column). The rows of all the columns of
+    # a dataset are aligned. Appended rows are buffered and written as a new chunk every chunk_rows rows (and on
+    # flush/close), so old files are never rewritten, and readers memory-map the chunks without parsing.
+    def __init__(self, directory: str, chunk_rows=1024):
+        self.directory = directory
+        self.chunk_rows = max(int(chunk_rows), 1)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'format': 1, 'datasets': dict()}
+        self.pending = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def set_attrs(self, dataset: str, attrs: dict):
+        # JSON attributes of a dataset (e.g. the model parameters), written with the manifest
+        self._dataset(dataset)['attrs'].update(attrs)
+
+    def append(self, dataset: str, columns: dict):
+        # Append rows: columns is {name: array}, all the arrays with the same number of rows (first axis)
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        rows = {len(values) for values in columns.values()}
+        if len(rows) != 1:
+            raise ValueError('The columns of {} have different numbers of rows: {}'.format(dataset, sorted(rows)))
+        pending = self.pending.setdefault(dataset, {'rows': 0, 'columns': dict()})
+        if pending['rows'] > 0 and set(columns) != set(pending['columns']):
+            raise ValueError('The columns of {} changed inside a chunk'.format(dataset))
+        for name, values in columns.items():
+            pending['columns'].setdefault(name, []).append(values)
+        pending['rows'] += rows.pop()
+        if pending['rows'] >= self.chunk_rows:
+            self._write_chunk(dataset)
+            self._write_manifest()
+
+    def flush(self):
+        for dataset in list(self.pending):
+            self._write_chunk(dataset)
+        self._write_manifest()
+
+    def close(self):
+        self.flush()
+
+    def _dataset(self, dataset):
+        return self.manifest['datasets'].setdefault(dataset, {'columns': dict(), 'chunks': [], 'attrs': dict()})
+
+    def _write_chunk(self, dataset):
+        pending = self.pending.pop(dataset, None)
+        if pending is None or pending['rows'] == 0:
+            return
+        info = self._dataset(dataset)
+        os.makedirs(os.path.join(self.directory, dataset), exist_ok=True)
+        chunk = {'rows': pending['rows'], 'files': dict()}
+        for name, parts in pending['columns'].items():
+            values = np.concatenate(parts)
+            dtype = values.dtype.str
+            if info['columns'].setdefault(name, dtype) != dtype:
+                raise ValueError('Column {}/{} has dtype {}, not {}'.format(dataset, name, dtype,
+                                                                           info['columns'][name]))
+            file_name = '{}/{}.{:05d}.npy'.format(dataset, re.sub(r'[^A-Za-z0-9_-]', '_', name), len(info['chunks']))
+            np.save(os.path.join(self.directory, file_name), values)
+            chunk['files'][name] = file_name
+        info['chunks'].append(chunk)
+
+    def _write_manifest(self):
+        # Replace the manifest at once, so a reader never sees a half written one
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, default=_json_default)
+        os.replace(path + '.tmp', path)
+
+
+def _json_default(value):
+    # Numpy scalars and arrays in attributes
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+def load_manifest(directory: str):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def load_chunks(directory: str, dataset: str, column: str, mmap_mode='r'):
+    # The chunks of one column, memory-mapped
+    manifest = load_manifest(directory)
+    return [np.load(os.path.join(directory, chunk['files'][column]), mmap_mode=mmap_mode)
+            for chunk in manifest['datasets'][dataset]['chunks']]
+
+
+def load_column(directory: str, dataset: str, column: str):
+    # All the rows of one column (the chunks must have the same shape of row)
+    return np.concatenate(load_chunks(directory, dataset, column))
+
+
+def export_series(exporter: ColumnarExporter, model, run=0):
+    # The series of the model's SeriesCollector, one row per collected tick. The agent series (collect_agents)
+    # go to the agent_series dataset, a row is the values of all the agents at one tick.
+    collector = model.datacollector
+    ticks = collector.get_ticks()
+    runs = np.full(len(ticks), run, dtype=np.int64)
+    exporter.set_attrs('series', {'params': model.params})
+    exporter.append('series', dict({'run': runs, 'tick': ticks}, **collector.model_vars))
+    if len(collector.agent_columns) > 0:
+        exporter.append('agent_series', dict({'run': runs, 'tick': ticks},
+                                             **{label: collector.get_agent_vars(label)
+                                                for label in collector.agent_columns}))
+
+
+def export_agents(exporter: ColumnarExporter, model, run=0, fields=None):
+    # Snapshot of the agent state store (all the fields, or the given ones), one row per agent
+    store = model.agent_state
+    columns = {'run': np.full(store.size, run, dtype=np.int64), 'tick': np.full(store.size, model.time)}
+    for name in AGENT_FIELDS if fields is None else fields:
+        columns[name] = store.column(name)
+    exporter.append('agents', columns)
+
+
+def export_infections(exporter: ColumnarExporter, model, run=0):
+    # The infection log of the model, one row per transmission
+    log = model.infections
+    columns = {'run': np.full(log.size, run, dtype=np.int64)}
+    columns.update(log.get_state()['columns'])
+    exporter.append('infections', columns)
+
+
+def export_replica_results(exporter: ColumnarExporter, results, series_names, run=0):
+    # Results of one replica (array of series x steps, like run_replica), one row per replica
+    results = np.asarray(results)
+    columns = {'run': np.array([run], dtype=np.int64)}
+    for name, values in zip(series_names, results):
+        columns[name] = values[np.newaxis]
+    exporter.append('replicas', columns)
+
+
+def export_aggregate(exporter: ColumnarExporter, aggregator, series_names, quantiles=(0.1, 0.5, 0.9), attrs=None):
+    # Statistics of a ReplicaAggregator, one row per series: the mean, std and quantiles of every step
+    columns = {'series': np.array(series_names, dtype='U64'), 'count': np.full(len(series_names), aggregator.count),
+               'mean': aggregator.mean, 'std': aggregator.std}
+    for q in quantiles:
+        columns['p{:g}'.format(q * 100)] = aggregator.quantile(q)
+    if attrs is not None:
+        exporter.set_attrs('aggregates', attrs)
+    exporter.append('aggregates', columns)
@@ -0,0 +1,153 @@
+import numpy as np
+
+
+class CellIndex:
+    # Agents grouped by grid cell (CSR layout): the rows of the agents in cell c are order[start[c]:start[c + 1]],
+    # where c = x * height + y. Built from the pos column of the agent state store.
+    def __init__(self, pos, width: int, height: int):
+        self.width = width
+        self.height = height
+        on_grid = np.flatnonzero(pos[:, 0] >= 0)
+        cells = pos[on_grid, 0].astype(np.int64) * height + pos[on_grid, 1]
+        self.order = on_grid[np.argsort(cells, kind='stable')]
+        self.start = np.zeros(width * height + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=width * height), out=self.start[1:])
+
+    def neighbor_pairs(self, rows, pos, radius=1):
+        # All the (row, neighbor row) pairs where the neighbor is in the Moore neighborhood of the row agent
+        # (center included), like get_cell_list_contents(get_neighborhood(pos, moore=True, include_center=True))
+        rows = np.asarray(rows, dtype=np.int64)
+        sources = []
+        neighbors = []
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                x = pos[rows, 0] + dx
+                y = pos[rows, 1] + dy
+                valid = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+                cells = x[valid].astype(np.int64) * self.height + y[valid]
+                counts = self.start[cells + 1] - self.start[cells]
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # Position of every pair inside its cell segment
+                within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                sources.append(np.repeat(rows[valid], counts))
+                neighbors.append(self.order[np.repeat(self.start[cells], counts) + within])
+        if len(sources) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(sources), np.concatenate(neighbors)
+
+
+def box_sum(grid, radius: int):
+    # Sum of every (2 * radius + 1) x (2 * radius + 1) box of the grid (clipped at the borders),
+    # using a summed-area table
+    width, height = grid.shape
+    table = np.zeros((width + 1, height + 1), dtype=np.int64)
+    table[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+    x_0 = np.clip(np.arange(width) - radius, 0, width)
+    x_1 = np.clip(np.arange(width) + radius + 1, 0, width)
+    y_0 = np.clip(np.arange(height) - radius, 0, height)
+    y_1 = np.clip(np.arange(height) + radius + 1, 0, height)
+    return table[np.ix_(x_1, y_1)] - table[np.ix_(x_0, y_1)] - table[np.ix_(x_1, y_0)] + table[np.ix_(x_0, y_0)]
+
+
+class CrowdField:
+    # Number of agents in every cell and in the Moore neighborhood (center included) of every cell.
+    # density[r][x, y] == len(grid.get_cell_list_contents(grid.get_neighborhood((x, y), True, True, r)))
+    # The fields are updated on every move, so reading the crowd around a cell is O(1).
+    def __init__(self, width: int, height: int, radii=(1, 2)):
+        self.occupancy = np.zeros((width, height), dtype=np.int32)
+        self.density = {r: np.zeros((width, height), dtype=np.int32) for r in radii}
+
+    def add(self, pos, k=1):
+        x, y = pos
+        self.occupancy[x, y] += k
+        for r, field in self.density.items():
+            field[max(x - r, 0):x + r + 1, max(y - r, 0):y + r + 1] += k
+
+    def remove(self, pos):
+        self.add(pos, -1)
+
+    def count(self, pos, radius=1):
+        return int(self.density[radius][pos[0], pos[1]])
+
+    def rebuild(self, pos):
+        # Recalculate the fields from the pos column of the agent state store
+        on_grid = pos[pos[:, 0] >= 0]
+        self.occupancy.fill(0)
+        np.add.at(self.occupancy, (on_grid[:, 0], on_grid[:, 1]), 1)
+        for r, field in self.density.items():
+            field[:] = box_sum(self.occupancy, r)
+
+
+class NeighborhoodTable:
+    # Moore neighborhoods (center included) of every cell of a width x height grid (no torus), in the order of
+    # MultiGrid.get_neighborhood. CSR layout: the neighbors of cell c = x * height + y are
+    # (x_of[start[c]:start[c + 1]], y_of[...]). The coordinate lists are built once per cell, on first use.
+    def __init__(self, width: int, height: int, radius: int):
+        self.width = width
+        self.height = height
+        self.radius = radius
+        x = np.repeat(np.arange(width), height)
+        y = np.tile(np.arange(height), width)
+        offsets = np.arange(-radius, radius + 1)
+        neighbor_x = (x[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]).repeat(len(offsets), 2)
+        neighbor_y = (y[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]).repeat(len(offsets), 1)
+        neighbor_x = neighbor_x.reshape(width * height, -1)
+        neighbor_y = neighbor_y.reshape(width * height, -1)
+        valid = (neighbor_x >= 0) & (neighbor_x < width) & (neighbor_y >= 0) & (neighbor_y < height)
+        self.start = np.zeros(width * height + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=self.start[1:])
+        self.x_of = neighbor_x[valid].astype(np.int32)
+        self.y_of = neighbor_y[valid].astype(np.int32)
+        self._lists = [None] * (width * height)
+
+    def __getitem__(self, pos):
+        cell = pos[0] * self.height + pos[1]
+        neighborhood = self._lists[cell]
+        if neighborhood is None:
+            begin, end = self.start[cell], self.start[cell + 1]
+            neighborhood = list(zip(self.x_of[begin:end].tolist(), self.y_of[begin:end].tolist()))
+            self._lists[cell] = neighborhood
+        return neighborhood
+
+
+_neighborhood_tables = dict()
+
+
+def neighborhood_table(width: int, height: int, radius: int):
+    # One table per grid size and radius, shared by all the models
+    key = (width, height, radius)
+    if key not in _neighborhood_tables:
+        _neighborhood_tables[key] = NeighborhoodTable(width, height, radius)
+    return _neighborhood_tables[key]
+
+
+class VenueLayout:
+    # Cells of the venue computed once per model, so the venue is never searched by rejection sampling:
+    # the cells out of the gathering area (destinations of out_move) and the cells where a table may stand.
+    # A table at (x, y) takes the cells (x, y) and (x + 1, y), and no other table stands within table_radius of it.
+    def __init__(self, gathering_layer, table_radius=3):
+        self.width, self.height = gathering_layer.shape
+        self.table_radius = table_radius
+        x, y = np.nonzero(~gathering_layer)
+        self.outside = list(zip(x.tolist(), y.tolist()))
+        xs, ys = np.arange(self.width)[:, np.newaxis], np.arange(self.height)[np.newaxis, :]
+        allowed = ~gathering_layer & (xs >= 1) & (ys >= 1) & (xs + 2 < self.width) & (ys + 1 < self.height)
+        self.table_cells = np.flatnonzero(allowed)
+
+    def place_tables(self, num_tables: int, generator):
+        # Random sequential placement: the allowed cells are visited in random order and every placed table
+        # blocks the cells around it. Returns up to num_tables positions (fewer if the venue is full).
+        blocked = np.zeros((self.width, self.height), dtype=bool)
+        r = self.table_radius
+        tables = []
+        for cell in generator.permutation(self.table_cells).tolist():
+            if len(tables) == num_tables:
+                break
+            x, y = divmod(cell, self.height)
+            if blocked[x, y]:
+                continue
+            tables.append((x, y))
+            blocked[max(x - r, 0):x + r + 1, max(y - r, 0):y + r + 1] = True
+        return tables
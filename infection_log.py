@@ -0,0 +1,164 @@
+import numpy as np
+
+# Columns of the infection log: name -> dtype
+INFECTION_FIELDS = {
+    'tick': np.int64,
+    'infector': np.int64,
+    'infectee': np.int64,
+    # Generation of the infectee by this transmission
+    'generation': np.int32,
+    # Action of the infector
+    'action': np.int8,
+    'infector_mask': np.bool_,
+    'infectee_mask': np.bool_,
+    # Cell of the infectee
+    'x': np.int32,
+    'y': np.int32,
+    # Tick the infector was infected at (0 for the initial carriers)
+    'infector_tick': np.int64,
+    # The infectee was not a carrier before (the other transmissions only lower its generation)
+    'new_case': np.bool_,
+}
+
+
+class InfectionLog:
+    # Append-only columnar log of every transmission, in tick order.
+    # The reproduction number is kept from the log as it is written. The cases infected at one tick are a cohort,
+    # their window is the `window` ticks from their infection tick (included, an agent can infect others in the
+    # tick it was infected). R is the mean number of new cases caused in the window by the cases of the last
+    # `cohorts` cohorts whose window is over (so their counts are final). Transmissions to agents that were already
+    # carriers are logged, but not counted in R.
+    def __init__(self, window=5, cohorts=5, capacity=1024):
+        self.window = window
+        self.cohorts = cohorts
+        self.capacity = max(int(capacity), 1)
+        self.size = 0
+        for name, dtype in INFECTION_FIELDS.items():
+            setattr(self, name, np.zeros(self.capacity, dtype=dtype))
+        # By tick: new cases, and new cases caused by the cases infected at that tick within their window
+        self.cases_by_tick = np.zeros(64, dtype=np.int64)
+        self.early_by_tick = np.zeros(64, dtype=np.int64)
+
+    def add_initial_cases(self, num_of_cases: int, tick=0):
+        self._reserve_ticks(tick)
+        self.cases_by_tick[tick] += num_of_cases
+
+    def record(self, tick, infector, infectee, generation, action, infector_mask, infectee_mask, cell,
+               infector_tick, new_case):
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+        i = self.size
+        self.tick[i] = tick
+        self.infector[i] = infector
+        self.infectee[i] = infectee
+        self.generation[i] = generation
+        self.action[i] = action
+        self.infector_mask[i] = infector_mask
+        self.infectee_mask[i] = infectee_mask
+        self.x[i], self.y[i] = cell
+        self.infector_tick[i] = infector_tick
+        self.new_case[i] = new_case
+        self.size += 1
+        self._reserve_ticks(tick)
+        if new_case:
+            self.cases_by_tick[tick] += 1
+            if tick - infector_tick < self.window:
+                self.early_by_tick[infector_tick] += 1
+
+    def record_many(self, tick, infectors, infectees, generations, actions, infector_masks, infectee_masks, cells,
+                    infector_ticks, new_cases):
+        # Record a batch of transmissions of one tick (arrays), e.g. the infections of a vectorized pass
+        n = len(infectors)
+        if n == 0:
+            return
+        if self.size + n > self.capacity:
+            self._grow(max(self.capacity * 2, self.size + n))
+        batch = slice(self.size, self.size + n)
+        self.tick[batch] = tick
+        self.infector[batch] = infectors
+        self.infectee[batch] = infectees
+        self.generation[batch] = generations
+        self.action[batch] = actions
+        self.infector_mask[batch] = infector_masks
+        self.infectee_mask[batch] = infectee_masks
+        self.x[batch] = cells[:, 0]
+        self.y[batch] = cells[:, 1]
+        self.infector_tick[batch] = infector_ticks
+        self.new_case[batch] = new_cases
+        self.size += n
+        self._reserve_ticks(tick)
+        new_cases = np.asarray(new_cases, dtype=bool)
+        self.cases_by_tick[tick] += int(np.count_nonzero(new_cases))
+        infector_ticks = np.asarray(infector_ticks)[new_cases]
+        np.add.at(self.early_by_tick, infector_ticks[tick - infector_ticks < self.window], 1)
+
+    def _reserve_ticks(self, tick):
+        # The counters by tick cover the ticks until tick (the infector ticks are never later than the tick)
+        if tick < len(self.cases_by_tick):
+            return
+        length = max(len(self.cases_by_tick) * 2, tick + 1)
+        for name in ('cases_by_tick', 'early_by_tick'):
+            new = np.zeros(length, dtype=np.int64)
+            old = getattr(self, name)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _grow(self, capacity):
+        for name, dtype in INFECTION_FIELDS.items():
+            new = np.zeros(capacity, dtype=dtype)
+            new[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def column(self, name):
+        return getattr(self, name)[:self.size]
+
+    def _closed_cohorts(self, tick):
+        # End (exclusive) of the cohorts whose window is over at the end of tick
+        return min(max(tick - self.window + 2, 0), len(self.cases_by_tick))
+
+    def reproduction_number(self, tick):
+        # R at the end of tick: mean new cases caused in the window by the cases of the last `cohorts` closed
+        # cohorts (0 if there are none)
+        last = self._closed_cohorts(tick)
+        return self._mean_cases(max(last - self.cohorts, 0), last)
+
+    def cumulative_reproduction_number(self, tick):
+        # The same mean over all the closed cohorts of the run
+        return self._mean_cases(0, self._closed_cohorts(tick))
+
+    def _mean_cases(self, first, last):
+        cases = self.cases_by_tick[first:last].sum()
+        if cases == 0:
+            return 0
+        return float(self.early_by_tick[first:last].sum() / cases)
+
+    def secondary_cases(self, num_of_agents: int):
+        # Number of new cases caused by every agent (by id)
+        return np.bincount(self.column('infector')[self.column('new_case')], minlength=num_of_agents)
+
+    def generation_counts(self):
+        # Number of new cases of every generation (the initial carriers, generation 1, are not in the log)
+        return np.bincount(self.column('generation')[self.column('new_case')])
+
+    def generation_intervals(self):
+        # Ticks from the infection of the infector to every transmission
+        return self.column('tick') - self.column('infector_tick')
+
+    def get_state(self):
+        return {'columns': {name: self.column(name).copy() for name in INFECTION_FIELDS},
+                'cases_by_tick': self.cases_by_tick.copy(), 'early_by_tick': self.early_by_tick.copy()}
+
+    def set_state(self, state):
+        size = len(state['columns']['tick'])
+        self.size = 0
+        self._grow(max(self.capacity, size))
+        for name in INFECTION_FIELDS:
+            getattr(self, name)[:size] = state['columns'][name]
+        self.size = size
+        self.cases_by_tick = state['cases_by_tick'].copy()
+        self.early_by_tick = state['early_by_tick'].copy()
+
+    def get_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name) for name in INFECTION_FIELDS})
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+
+# Phases of a step: the agent phases are methods of PopAgent/WaiterAgent, decision is the walk of the moving
+# decision tree (inside move), reporters are the model reporters (inside collect), the others are model phases
+AGENT_PHASES = {'arrival': 'active_agent', 'move': 'move', 'choose_action': 'choose_action',
+                'update_social_influence': 'update_social_influence', 'wear_mask': 'wear_mask',
+                'contagious': 'contagious'}
+PHASES = ['arrival', 'move', 'decision', 'choose_action', 'update_social_influence', 'wear_mask', 'contagious',
+          'friend_affinity', 'agents', 'vectorized_contagion', 'cal_R', 'collect', 'reporters']
+
+
+class StepProfiler:
+    # Opt-in timing of the phases of the model step, one row per tick in a counter table of seconds and calls
+    # of every phase. The phases of a nested call are counted in both (decision in move, reporters in collect).
+    # The model instruments the methods of its own agents when it gets a profiler, so a model without one
+    # pays nothing.
+    def __init__(self, capacity=64):
+        self.phases = list(PHASES)
+        self.index = {phase: i for i, phase in enumerate(self.phases)}
+        self.capacity = max(int(capacity), 1)
+        self.size = 0
+        self.ticks = np.zeros(self.capacity, dtype=np.int64)
+        self.seconds = np.zeros((self.capacity, len(self.phases)))
+        self.calls = np.zeros((self.capacity, len(self.phases)), dtype=np.int64)
+        # The row of the current tick, as lists (cheaper to update than the arrays)
+        self._tick = None
+        self._seconds = [0.0] * len(self.phases)
+        self._calls = [0] * len(self.phases)
+
+    def instrument(self, model):
+        for agent in model.agent_state.agents:
+            for phase, method in AGENT_PHASES.items():
+                setattr(agent, method, self.wrap(phase, getattr(agent, method)))
+        tree = model.move_decision_tree
+        tree.decide = self.wrap('decision', tree.decide)
+        model.schedule.step = self.wrap('agents', model.schedule.step)
+        model.cal_R = self.wrap('cal_R', model.cal_R)
+        collector = model.datacollector
+        collector.collect = self.wrap('collect', collector.collect)
+        collector.model_reporters = {label: self.wrap('reporters', reporter)
+                                     for label, reporter in collector.model_reporters.items()}
+
+    def wrap(self, phase, function):
+        i = self.index[phase]
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._seconds[i] += time.perf_counter() - started
+                self._calls[i] += 1
+
+        return timed
+
+    def run(self, phase, function, *args):
+        return self.wrap(phase, function)(*args)
+
+    def begin_tick(self, tick):
+        if self._tick is not None:
+            self.end_tick()
+        self._tick = tick
+        self._seconds = [0.0] * len(self.phases)
+        self._calls = [0] * len(self.phases)
+
+    def end_tick(self):
+        if self._tick is None:
+            return
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+        self.ticks[self.size] = self._tick
+        self.seconds[self.size] = self._seconds
+        self.calls[self.size] = self._calls
+        self.size += 1
+        self._tick = None
+
+    def _grow(self, capacity):
+        for name in ('ticks', 'seconds', 'calls'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def get_ticks(self):
+        return self.ticks[:self.size]
+
+    def get_seconds(self, phase):
+        return self.seconds[:self.size, self.index[phase]]
+
+    def get_calls(self, phase):
+        return self.calls[:self.size, self.index[phase]]
+
+    def totals(self):
+        # {phase: (seconds, calls)} of the whole run
+        return {phase: (float(self.seconds[:self.size, i].sum()), int(self.calls[:self.size, i].sum()))
+                for i, phase in enumerate(self.phases)}
+
+    def get_dataframe(self):
+        # Seconds and calls of every phase by tick, with the index of SeriesCollector.get_model_vars_dataframe
+        import pandas as pd
+        columns = dict()
+        for i, phase in enumerate(self.phases):
+            columns[phase + ' seconds'] = self.seconds[:self.size, i]
+            columns[phase + ' calls'] = self.calls[:self.size, i]
+        return pd.DataFrame(columns, index=pd.Index(self.get_ticks(), name='Step'))
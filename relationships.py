@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class RelationshipStore:
+    # Relationship level of every couple of people, by unique_id (the people ids are 0..num_people - 1).
+    # The levels of the couples (a, b), a < b, are kept in one float32 array in the order of
+    # itertools.combinations (the upper triangle, row by row): N * (N - 1) / 2 entries, 200MB for 10k people.
+    # A homogeneous store keeps no array, and couples with an agent that is not a person (waiters) or with
+    # the agent itself have the default level.
+    def __init__(self, num_people: int, default=0.0):
+        self.num_people = num_people
+        self.default = default
+        self.levels = None
+
+    def fill_normal(self, generator, loc=0.0, scale=1.0, chunk=1 << 22):
+        # Draw every level from N(loc, scale), in chunks so there are no float64 temporaries of the full size
+        n = self.num_people
+        self.levels = np.empty(n * (n - 1) // 2, dtype=np.float32)
+        for start in range(0, len(self.levels), chunk):
+            block = self.levels[start:start + chunk]
+            generator.standard_normal(len(block), dtype=np.float32, out=block)
+            block *= scale
+            block += loc
+
+    def _offset(self, a, b):
+        # Position of the couple (a, b), a < b, in the levels array
+        return a * (2 * self.num_people - a - 1) // 2 + (b - a - 1)
+
+    def get(self, a: int, b: int):
+        if self.levels is None or a == b or not (0 <= a < self.num_people and 0 <= b < self.num_people):
+            return self.default
+        if a > b:
+            a, b = b, a
+        return float(self.levels[self._offset(a, b)])
+
+    def __getitem__(self, couple):
+        # relationship_level[lower_first(a, b)], like the dict it replaces
+        return self.get(*couple)
+
+    def lookup(self, a_ids, b_ids):
+        # Vectorized get: the levels of the couples (a_ids[i], b_ids[i]), a scalar id is broadcast
+        a_ids, b_ids = np.broadcast_arrays(np.asarray(a_ids, dtype=np.int64), np.asarray(b_ids, dtype=np.int64))
+        result = np.full(a_ids.shape, self.default, dtype=np.float64)
+        if self.levels is None:
+            return result
+        valid = (a_ids != b_ids) & (a_ids >= 0) & (a_ids < self.num_people) & \
+                (b_ids >= 0) & (b_ids < self.num_people)
+        low = np.minimum(a_ids[valid], b_ids[valid])
+        high = np.maximum(a_ids[valid], b_ids[valid])
+        result[valid] = self.levels[self._offset(low, high)]
+        return result
+
+    def row(self, a: int):
+        # The levels of a with every person (indexed by id)
+        result = np.full(self.num_people, self.default, dtype=np.float64)
+        if self.levels is None or not 0 <= a < self.num_people:
+            return result
+        before = np.arange(a)
+        result[:a] = self.levels[self._offset(before, a)]
+        start = self._offset(a, a + 1)
+        result[a + 1:] = self.levels[start:start + self.num_people - a - 1]
+        return result
+
+    def get_state(self):
+        return None if self.levels is None else self.levels.copy()
+
+    def set_state(self, levels):
+        self.levels = None if levels is None else np.array(levels, dtype=np.float32)
+
+
+def partner_rank(levels, rank: int, rows):
+    # Index of the rank-th candidate by (level descending, row) (rank 0 is the highest, ranks past the end give
+    # the last one), by partial selection instead of a full sort. rows are the distinct agent state store rows of
+    # the candidates, they break the ties of levels the same way as batch_partners.
+    levels, rows = np.asarray(levels), np.asarray(rows)
+    rank = min(max(rank, 0), len(levels) - 1)
+    kth = len(levels) - 1 - rank
+    level = np.partition(levels, kth)[kth]
+    ties = np.flatnonzero(levels == level)
+    rank -= int(np.count_nonzero(levels > level))
+    return int(ties[np.argpartition(rows[ties], rank)[rank]])
+
+
+def batch_partners(sources, candidates, levels, choosers, ranks, available, pair=None):
+    # Pair many agents in one pass. (sources[i], candidates[i]) are the possible couples (agent state store rows)
+    # and levels[i] their relationship levels. The choosers pick in order: a chooser that is still available takes
+    # its ranks[j]-th available candidate by (level descending, row), the last one if it has fewer, like
+    # partner_rank. pair(chooser, partner) is called for every choice in order (partner is the chooser itself if
+    # it found nobody), both leave the pool if it returns True; without pair every couple leaves the pool.
+    # Returns the partner of every chooser: itself if it found nobody, -1 if it was not available.
+    order = np.lexsort((candidates, -np.asarray(levels), sources))
+    sources, candidates = np.asarray(sources)[order], np.asarray(candidates)[order]
+    starts = np.searchsorted(sources, choosers, side='left')
+    ends = np.searchsorted(sources, choosers, side='right')
+    available = np.array(available, dtype=bool)
+    partners = np.full(len(choosers), -1, dtype=np.int64)
+    for j, chooser in enumerate(choosers):
+        if not available[chooser]:
+            continue
+        segment = candidates[starts[j]:ends[j]]
+        free = segment[available[segment] & (segment != chooser)]
+        if len(free) == 0:
+            partners[j] = chooser
+            if pair is not None:
+                pair(chooser, chooser)
+            continue
+        partners[j] = free[min(ranks[j], len(free) - 1)]
+        if pair is None or pair(chooser, partners[j]):
+            available[chooser] = available[partners[j]] = False
+    return partners
@@ -0,0 +1,204 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from CleanCloseCorona import CoronaCloseModel, count_carried, count_crowd, count_mask
+from export import export_replica_results
+
+# The series of an averaged simulation, in the order of results_names in Clean_viz
+REPLICA_SERIES = (count_carried, count_crowd, count_mask)
+
+
+class ProgressReporter:
+    # Progress of an averaged simulation, counted in model steps. update is cheap to call on every step,
+    # report runs at most once every min_interval seconds (and at the end) with the ETA from the measured step time
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self.total = 0
+        self.done = 0
+        self.started = 0
+        self.last_report = -math.inf
+
+    def start(self, total: int):
+        self.total = total
+        self.done = 0
+        self.started = time.perf_counter()
+        self.last_report = -math.inf
+
+    def update(self, steps=1):
+        self.done += steps
+        now = time.perf_counter()
+        if now - self.last_report < self.min_interval and self.done < self.total:
+            return
+        self.last_report = now
+        self.report(self.done, self.total, self.eta(now))
+
+    def eta(self, now=None):
+        # Seconds left: measured time per step times the steps left
+        if self.done == 0:
+            return math.inf
+        if now is None:
+            now = time.perf_counter()
+        return (now - self.started) / self.done * (self.total - self.done)
+
+    def finish(self):
+        pass
+
+    def report(self, done: int, total: int, eta: float):
+        pass
+
+
+class NullProgress(ProgressReporter):
+    def update(self, steps=1):
+        pass
+
+
+class CallbackProgress(ProgressReporter):
+    # Calls callback(done, total, eta_seconds) on every throttled update
+    def __init__(self, callback, min_interval=1.0):
+        super().__init__(min_interval)
+        self.callback = callback
+
+    def report(self, done: int, total: int, eta: float):
+        self.callback(done, total, eta)
+
+
+class ConsoleProgress(ProgressReporter):
+    def report(self, done: int, total: int, eta: float):
+        finish_at = time.strftime('%H:%M:%S', time.localtime(time.time() + eta)) if eta < math.inf else '--:--:--'
+        print('\r{}/{} steps ({:.0%}), finish time: {}'.format(done, total, done / max(total, 1), finish_at),
+              end='', flush=True)
+
+    def finish(self):
+        print()
+
+
+class ReplicaAggregator:
+    # Streaming statistics of replica series, per series and step, in memory that does not depend on the number
+    # of replicas: running mean and variance (Welford) and a fixed-bins histogram for approximate quantiles.
+    # Aggregators of different workers are merged with merge (Chan et al. for the mean and variance).
+    def __init__(self, num_of_series: int, num_of_steps: int, value_range=(0, 1), bins=256):
+        self.count = 0
+        self.mean = np.zeros((num_of_series, num_of_steps))
+        self.m2 = np.zeros((num_of_series, num_of_steps))
+        self.low, self.high = float(value_range[0]), float(value_range[1])
+        if self.high <= self.low:
+            self.high = self.low + 1
+        self.bins = bins
+        self.histogram = np.zeros((num_of_series, num_of_steps, bins), dtype=np.int64)
+
+    def add(self, results):
+        # results: array of (series, step) of one replica
+        results = np.asarray(results, dtype=np.float64)
+        self.count += 1
+        delta = results - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (results - self.mean)
+        bin_index = np.clip(((results - self.low) / (self.high - self.low) * self.bins).astype(np.int64),
+                            0, self.bins - 1)
+        histogram = self.histogram.reshape(-1, self.bins)
+        histogram[np.arange(len(histogram)), bin_index.ravel()] += 1
+
+    def merge(self, other: "ReplicaAggregator"):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.histogram += other.histogram
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantile(self, q: float):
+        # Approximate q-quantile of every (series, step), interpolated inside the histogram bin
+        cumulative = self.histogram.cumsum(axis=-1)
+        target = q * self.count
+        index = np.argmax(cumulative >= target, axis=-1)[..., np.newaxis]
+        before = np.where(index > 0, np.take_along_axis(cumulative, np.maximum(index - 1, 0), axis=-1), 0)
+        in_bin = np.maximum(np.take_along_axis(self.histogram, index, axis=-1), 1)
+        fraction = np.clip((target - before) / in_bin, 0, 1)
+        return (self.low + (index + fraction) * (self.high - self.low) / self.bins)[..., 0]
+
+
+def replica_seeds(num_of_simulations: int, seed=None):
+    # Independent seeds for the replicas, spawned from one root seed
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(num_of_simulations)]
+
+
+def run_replica(model_params: dict, during_of_simulation: int, seed: int, progress=None):
+    # Run one CoronaCloseModel and return its series as an array of (series, step)
+    # The model draws all its random numbers from its own streams, seeded with seed.
+    # progress (in this process only) is updated on every step
+    model = CoronaCloseModel(seed=seed, **model_params)
+    results = np.zeros((len(REPLICA_SERIES), during_of_simulation))
+    for i in range(during_of_simulation):
+        model.step()
+        for j, reporter in enumerate(REPLICA_SERIES):
+            results[j, i] = reporter(model)
+        if progress is not None:
+            progress.update()
+    return results
+
+
+def run_replica_chunk(model_params: dict, during_of_simulation: int, seeds, value_range, bins, keep_results=False):
+    # Run some replicas in one worker and return their aggregator, and with keep_results the results
+    # of every replica as well (for the export), else None
+    aggregator = ReplicaAggregator(len(REPLICA_SERIES), during_of_simulation, value_range, bins)
+    results = [] if keep_results else None
+    for s in seeds:
+        replica = run_replica(model_params, during_of_simulation, s)
+        aggregator.add(replica)
+        if keep_results:
+            results.append(replica)
+    return aggregator, results
+
+
+def aggregate_replicas(model_params: dict, num_of_simulations: int, during_of_simulation: int, value_range,
+                       bins=256, processes=None, seed=None, progress=None, exporter=None):
+    # Run the replicas across a process pool, every worker aggregates its chunk of replicas
+    # and the parent merges the chunk aggregators. With an exporter the workers return the results of their
+    # replicas too and the parent writes them (the run column is the index of the replica's seed)
+    seeds = replica_seeds(num_of_simulations, seed)
+    series_names = [reporter.__name__ for reporter in REPLICA_SERIES]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(min(processes, num_of_simulations), 1)
+    if progress is None:
+        progress = NullProgress()
+    progress.start(num_of_simulations * during_of_simulation)
+    aggregator = ReplicaAggregator(len(REPLICA_SERIES), during_of_simulation, value_range, bins)
+    if processes == 1:
+        for run, s in enumerate(seeds):
+            results = run_replica(model_params, during_of_simulation, s, progress)
+            aggregator.add(results)
+            if exporter is not None:
+                export_replica_results(exporter, results, series_names, run)
+        progress.finish()
+        return aggregator
+    # A few chunks per worker, so the progress moves while the pool is busy
+    num_of_chunks = min(processes * 4, num_of_simulations)
+    runs = [list(range(i, num_of_simulations, num_of_chunks)) for i in range(num_of_chunks)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(run_replica_chunk, model_params, during_of_simulation, [seeds[run] for run in chunk],
+                               value_range, bins, exporter is not None): chunk for chunk in runs}
+        for future in as_completed(futures):
+            chunk_aggregator, results = future.result()
+            aggregator.merge(chunk_aggregator)
+            if exporter is not None:
+                for run, replica in zip(futures[future], results):
+                    export_replica_results(exporter, replica, series_names, run)
+            progress.update(len(futures[future]) * during_of_simulation)
+    progress.finish()
+    return aggregator
@@ -0,0 +1,53 @@
+import pytest
+
+from CleanCloseCorona import CoronaCloseModel, CountryStatus, AirStatus
+
+PARAMS = dict(N=200, height=30, width=30, country_status=CountryStatus.MIDDLE_MORBIDITY,
+              air_condition=AirStatus.STANDING_AIR, inf_coeff=[1, 1, 1, 1], infRate=[0.1, 0.25, 0.25, 1],
+              mask_coeff=[1, 1, 1, 1, 1], entry_num=0, arrival_rate=1, conference_area=[5, 5, 15, 15, 3],
+              relationship=True, get_away=True, actions=True)
+
+
+def run(models, steps):
+    # Step the models side by side and return their Ills series
+    for _ in range(steps):
+        for model in models:
+            model.step()
+    return [model.datacollector.model_vars['Ills'].tolist() for model in models]
+
+
+def warm_up(steps=5, **params):
+    model = CoronaCloseModel(seed=0, **dict(PARAMS, **params))
+    run([model], steps)
+    return model
+
+
+def test_same_seed_same_run():
+    assert run([CoronaCloseModel(seed=3, **PARAMS)], 10) == run([CoronaCloseModel(seed=3, **PARAMS)], 10)
+
+
+def test_forks_side_by_side_match_solo_runs():
+    snapshot = warm_up().snapshot()
+    solo = [run([CoronaCloseModel.fork(snapshot, seed=seed)], 10)[0] for seed in (1, 2)]
+    assert run([CoronaCloseModel.fork(snapshot, seed=seed) for seed in (1, 2)], 10) == solo
+
+
+def test_fork_without_seed_repeats_the_original():
+    original = warm_up()
+    fork = CoronaCloseModel.fork(original.snapshot())
+    series = run([original, fork], 10)
+    assert series[0] == series[1]
+
+
+@pytest.mark.parametrize('override', [dict(N=100), dict(height=40), dict(width=40), dict(relationship=False),
+                                      dict(tables=True), dict(waiters=True)])
+def test_fork_rejects_structural_overrides(override):
+    with pytest.raises(ValueError):
+        CoronaCloseModel.fork(warm_up(steps=1).snapshot(), **override)
+
+
+def test_fork_with_behavioural_override():
+    fork = CoronaCloseModel.fork(warm_up().snapshot(), seed=1, mask_coeff=[1, 5, 1, 1, 1])
+    assert fork.mask_coeff == [1, 5, 1, 1, 1]
+    run([fork], 3)
+    assert fork.time == 8
@@ -0,0 +1,63 @@
+import numpy as np
+
+# Kinds of trace events
+DECISION = 0  # path: the nodes of the moving decision tree the agent visited
+ACTION = 1  # value: the action the agent chose, other: its partner
+INFECTION = 2  # agent infected other, value: the generation of the infected agent
+
+MAX_PATH = 8
+
+TRACE_DTYPE = np.dtype([('tick', np.int64), ('agent', np.int64), ('kind', np.int8), ('value', np.int32),
+                        ('other', np.int64), ('path', np.int16, (MAX_PATH,))])
+
+
+class Tracer:
+    # Bounded ring buffer of structured trace events: once capacity events were recorded the oldest are overwritten.
+    # Only sampled agents are traced: the agents in `agents` (all when None), each event with `probability`.
+    # The model keeps tracer=None when tracing is off, so the hot paths only pay for one None check.
+    def __init__(self, capacity=100000, agents=None, probability=1.0, seed=None):
+        self.capacity = capacity
+        self.events = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self.count = 0
+        self.agents = None if agents is None else set(agents)
+        self.probability = probability
+        self.rng = np.random.default_rng(seed)
+        # Names of the decision tree nodes, for decode_path
+        self.node_names = []
+
+    def sampled(self, agent_id):
+        if self.agents is not None and agent_id not in self.agents:
+            return False
+        return self.probability >= 1 or self.rng.random() < self.probability
+
+    def record(self, tick, agent, kind, value=-1, other=-1, path=()):
+        event = self.events[self.count % self.capacity]
+        event['tick'] = tick
+        event['agent'] = agent
+        event['kind'] = kind
+        event['value'] = value
+        event['other'] = other
+        event['path'] = -1
+        event['path'][:len(path)] = path[:MAX_PATH]
+        self.count += 1
+
+    def record_many(self, tick, agents, kind, values, others):
+        # Record a batch of events (with sampling), e.g. the infections of a vectorized pass
+        agents = np.asarray(agents)
+        keep = np.ones(len(agents), dtype=bool)
+        if self.agents is not None:
+            keep &= np.isin(agents, list(self.agents))
+        if self.probability < 1:
+            keep &= self.rng.random(len(agents)) < self.probability
+        for agent, value, other in zip(agents[keep], np.asarray(values)[keep], np.asarray(others)[keep]):
+            self.record(tick, agent, kind, value, other)
+
+    def to_array(self):
+        # The recorded events that are still in the buffer, oldest first
+        if self.count <= self.capacity:
+            return self.events[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate([self.events[start:], self.events[:start]])
+
+    def decode_path(self, event):
+        return [self.node_names[n] for n in event['path'] if n >= 0]
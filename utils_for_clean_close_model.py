@@ -1,3 +1,4 @@
+import math
 from enum import IntEnum
 
 import numpy as np
@@ -34,23 +35,15 @@ class DecisionNode(DecisionTreeNode):
 
 # Build specific moving decision tree
 def build_moving_decision_tree():
-    actions = {'random_move': [None], 'move_away': [None], 'conference_move': [None], 'out_move': [None],
-               'friends_move': [None], 'back_seat_move': [None]}
-
     # Depth 0
-    moving_decision_tree = DecisionTree(head=SplitNode(name='there_is_conference', threshold=0), action_dict=actions)
-    # Actions
-    random_move_action = DecisionNode(name='random_move',
-                                      action=moving_decision_tree.action_dict['random_move'])
-    move_away_action = DecisionNode(name='move_away',
-                                    action=moving_decision_tree.action_dict['move_away'])
-    conference_move_action = DecisionNode(name='conference_move',
-                                          action=moving_decision_tree.action_dict['conference_move'])
-    out_move_action = DecisionNode(name='out_move',
-                                   action=moving_decision_tree.action_dict['out_move'])
-    friends_move_action = DecisionNode(name='friends_move', action=moving_decision_tree.action_dict['friends_move'])
-    back_seat_move_action = DecisionNode(name='back_seat_move',
-                                         action=moving_decision_tree.action_dict['back_seat_move'])
+    moving_decision_tree = DecisionTree(head=SplitNode(name='there_is_conference', threshold=0))
+    # Actions (the leaves hold the name of the move)
+    random_move_action = DecisionNode(name='random_move', action='random_move')
+    move_away_action = DecisionNode(name='move_away', action='move_away')
+    conference_move_action = DecisionNode(name='conference_move', action='conference_move')
+    out_move_action = DecisionNode(name='out_move', action='out_move')
+    friends_move_action = DecisionNode(name='friends_move', action='friends_move')
+    back_seat_move_action = DecisionNode(name='back_seat_move', action='back_seat_move')
 
     # Known subtrees
     move_away_from_crowd = SplitNode(name='move_away_from_crowd')
@@ -98,10 +91,8 @@ def build_moving_decision_tree():
 
 def in_calculate_decision(curr, path):
     if type(curr) == DecisionNode:
-        print(curr.name)
         path.append(curr.name)
         return curr.action
-    print(curr.name)
     path.append(curr.name)
     if throw_coin(curr.threshold):
         return in_calculate_decision(curr.go_left(), path)
@@ -128,6 +119,111 @@ class DecisionTree:
     def calculate_decision(self, path):
         return in_calculate_decision(self.head, path)
 
+    def compile(self):
+        return CompiledDecisionTree(self)
+
+
+class CompiledDecisionTree:
+    # Flat array form of a DecisionTree. Node i (0 is the head) is a split node with children left[i]/right[i],
+    # or a leaf with the action actions[leaf_action[i]]. The thresholds are not part of the tree, they are passed
+    # to every decision (indexed by node), so one compiled tree serves any number of agents at the same time.
+    def __init__(self, tree: DecisionTree):
+        self.names = []
+        self.index = dict()
+        nodes = []
+        stack = [tree.head]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.name in self.index:
+                continue
+            self.index[node.name] = len(nodes)
+            self.names.append(node.name)
+            nodes.append(node)
+            if type(node) != DecisionNode:
+                stack += [node.right, node.left]
+        self.num_nodes = len(nodes)
+        self.is_leaf = np.array([type(node) == DecisionNode for node in nodes])
+        self.left = np.array([-1 if leaf else self.index[node.left.name] for node, leaf in zip(nodes, self.is_leaf)])
+        self.right = np.array([-1 if leaf else self.index[node.right.name] for node, leaf in zip(nodes, self.is_leaf)])
+        self.actions = [node.action for node in nodes if type(node) == DecisionNode]
+        self.leaf_action = np.full(self.num_nodes, -1)
+        self.leaf_action[self.is_leaf] = np.arange(len(self.actions))
+        # Default thresholds, the ones that were set on the split nodes
+        self.default_thresholds = np.array([0 if leaf else node.threshold for node, leaf in zip(nodes, self.is_leaf)],
+                                           dtype=float)
+        self.depth = self._depth(0)
+        # Python lists for the scalar walk
+        self._left = self.left.tolist()
+        self._right = self.right.tolist()
+        self._is_leaf = self.is_leaf.tolist()
+        self._leaf_action = self.leaf_action.tolist()
+        self._default_thresholds = self.default_thresholds.tolist()
+
+    def _depth(self, node):
+        if self.is_leaf[node]:
+            return 0
+        return 1 + max(self._depth(self.left[node]), self._depth(self.right[node]))
+
+    def threshold_vector(self, thresholds: dict):
+        # Thresholds by node, from {node name: threshold}, the others keep their default
+        vector = self.default_thresholds.tolist()
+        for name, threshold in thresholds.items():
+            vector[self.index[name]] = threshold
+        return vector
+
+    def node_providers(self, providers: dict):
+        # Providers by node, from {node name: provider} (None for the nodes without a provider)
+        return [providers.get(name) for name in self.names]
+
+    def decide(self, thresholds, path=None, rng=None):
+        # Walk from the head for one agent, return the name of the chosen action.
+        # thresholds is indexed by node: a list from threshold_vector or a LazyThresholds
+        node = 0
+        while not self._is_leaf[node]:
+            if path is not None:
+                path.append(self.names[node])
+            node = self._left[node] if throw_coin(thresholds[node], rng) else self._right[node]
+        if path is not None:
+            path.append(self.names[node])
+        return self.actions[self._leaf_action[node]]
+
+    def decide_batch(self, thresholds, rng=None):
+        # Walk the tree for many agents at once, thresholds is a matrix of agents x nodes.
+        # Returns the action ids (index into actions) and the visited nodes of every agent (padded with -1)
+        thresholds = np.asarray(thresholds, dtype=float)
+        num_agents = len(thresholds)
+        node = np.zeros(num_agents, dtype=np.int64)
+        paths = np.full((num_agents, self.depth + 1), -1)
+        agents = np.arange(num_agents)
+        done = np.zeros(num_agents, dtype=bool)
+        for d in range(self.depth + 1):
+            paths[~done, d] = node[~done]
+            leaf = self.is_leaf[node]
+            done |= leaf
+            if done.all():
+                break
+            coins = np.random.random(num_agents) if rng is None else rng.random_array(num_agents)
+            coin = coins < thresholds[agents, node]
+            node = np.where(leaf, node, np.where(coin, self.left[node], self.right[node]))
+        return self.leaf_action[node], paths
+
+
+class LazyThresholds:
+    # Thresholds by node for one walk of a CompiledDecisionTree, each one is computed only when the walk reaches
+    # its node. providers[node] (from node_providers) is the name of a method of owner that is called with args,
+    # None keeps the default threshold of the node.
+    def __init__(self, tree: CompiledDecisionTree, providers, owner, *args):
+        self.defaults = tree._default_thresholds
+        self.providers = providers
+        self.owner = owner
+        self.args = args
+
+    def __getitem__(self, node):
+        provider = self.providers[node]
+        if provider is None:
+            return self.defaults[node]
+        return getattr(self.owner, provider)(*self.args)
+
 
 # Enum classes
 class HealthStatus(IntEnum):
@@ -160,20 +256,55 @@ class Action(IntEnum):
 
 
 # Help class
-class Queue:
-    def __init__(self, n: int):
-        self.queue = []
-        self.max_len = n
-
-    def insert(self, x):
-        self.queue.append(x)
-        if len(self.queue) > self.max_len:
-            self.queue.pop(0)
+class RandomStream:
+    # Seeded numpy Generator of one model. Scalars are handed out from blocks that are drawn at once,
+    # so a scalar costs a list lookup instead of a Generator call.
+    def __init__(self, seed=None, block_size=4096):
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._uniform = []
+        self._uniform_index = 0
+        self._normal = []
+        self._normal_index = 0
+
+    def random(self):
+        if self._uniform_index == len(self._uniform):
+            self._uniform = self.generator.random(self.block_size).tolist()
+            self._uniform_index = 0
+        self._uniform_index += 1
+        return self._uniform[self._uniform_index - 1]
+
+    def normal(self, loc=0.0, scale=1.0):
+        if self._normal_index == len(self._normal):
+            self._normal = self.generator.standard_normal(self.block_size).tolist()
+            self._normal_index = 0
+        self._normal_index += 1
+        return loc + scale * self._normal[self._normal_index - 1]
+
+    def geometric(self, p: float):
+        # Number of trials until the first success (inverse transform of one uniform)
+        return max(int(math.ceil(math.log(1 - self.random()) / math.log(1 - p))), 1)
+
+    def random_array(self, n: int):
+        # Bulk draws go directly to the Generator
+        return self.generator.random(n)
+
+    def get_state(self):
+        # The Generator state and the unused part of the blocks, so a restored stream continues exactly
+        return {'generator': self.generator.bit_generator.state,
+                'uniform': self._uniform[self._uniform_index:], 'normal': self._normal[self._normal_index:]}
+
+    def set_state(self, state):
+        self.generator.bit_generator.state = state['generator']
+        self._uniform, self._uniform_index = list(state['uniform']), 0
+        self._normal, self._normal_index = list(state['normal']), 0
 
 
 # Utils functions
-def throw_coin(x: float):
-    return np.random.random() < x
+def throw_coin(x: float, rng: RandomStream = None):
+    if rng is None:
+        return np.random.random() < x
+    return rng.random() < x
 
 
 def logistic_prob(factors=None, variables=None, expected_value=0.5):
@@ -184,6 +315,34 @@ def logistic_prob(factors=None, variables=None, expected_value=0.5):
     return 1 / (1 + np.exp(-exponent))
 
 
+def normalize_factors(factors):
+    # The factors of logistic_prob normalized once (they are fixed for the whole run), as a tuple of floats
+    if factors is None:
+        return None
+    norm = sum([f for f in factors])
+    return tuple(float(f) / norm for f in factors)
+
+
+def logistic_prob_normalized(weights=None, variables=None, expected_value=0.5):
+    # logistic_prob with weights from normalize_factors
+    if weights is None or variables is None:
+        return 0
+    exponent = (sum([w * v for w, v in zip(weights, variables)]) - expected_value) / 0.1
+    if exponent < -700:
+        return 0.0
+    return 1 / (1 + math.exp(-exponent))
+
+
+def logistic_prob_batch(weights=None, variables=None, expected_value=0.5):
+    # logistic_prob of many agents at once: variables is a matrix of agents x variables,
+    # weights from normalize_factors
+    if weights is None or variables is None:
+        return 0
+    exponent = (np.asarray(variables, dtype=float) @ np.asarray(weights) - expected_value) / 0.1
+    with np.errstate(over='ignore'):
+        return 1 / (1 + np.exp(-exponent))
+
+
 def dist(a, b):
     return np.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
 